@@ -7,14 +7,15 @@ from flask import (
     render_template,
     url_for
 )
-from cachetools import LFUCache
 from flask_bootstrap import Bootstrap
 from flask_caching import Cache
 from flask_login import LoginManager, logout_user, current_user
 from flask_wtf.csrf import CSRFProtect
+from .backends import create_backend
+from .cache import KeyCache, SingleFlight
 from .config import config
-import datetime
-import sys
+from .metrics import InstrumentedBackend, init_app as init_metrics
+from concurrent.futures import ThreadPoolExecutor
 
 csrf = CSRFProtect()
 bootstrap = Bootstrap()
@@ -29,7 +30,72 @@ def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
-    app.extensions['lfu_cache'] = LFUCache(100e6, getsizeof=lambda i: sys.getsizeof(i)) # ~100 MB
+
+    def refresh_cached(cache_key):
+        from .storage import refresh_object
+        app.extensions['storage_executor'].submit(refresh_object, app, cache_key)
+
+    app.extensions['key_cache'] = KeyCache(
+        max_bytes=app.config.get('CACHE_MAX_BYTES'),
+        ttl=app.config.get('CACHE_TTL'),
+        soft_ttl=app.config.get('CACHE_SOFT_TTL'),
+        on_stale=refresh_cached,
+        segments=app.config.get('CACHE_SEGMENTS'),
+        negative_maxsize=app.config.get('NEGATIVE_CACHE_SIZE'),
+        negative_ttl=app.config.get('NEGATIVE_CACHE_TTL'),
+    )
+    app.extensions['key_loads'] = SingleFlight()
+    metrics = init_metrics(app)
+    app.extensions['storage'] = InstrumentedBackend(create_backend(app.config), metrics)
+    app.extensions['storage_executor'] = ThreadPoolExecutor(
+        max_workers=app.config.get('STORAGE_MAX_WORKERS'),
+        thread_name_prefix='storage',
+    )
+
+    if app.config.get('CACHE_PRELOAD_ENABLE'):
+        from .keystate import preload
+        try:
+            loaded = preload(app.extensions['storage'], app.extensions['key_cache'], app.config.get('CACHE_PRELOAD_MAX_AGE'))
+            app.logger.info("Preloaded %s keys into the cache", loaded)
+        except Exception:
+            app.logger.exception("Couldn't preload the key cache")
+
+    if app.config.get('HOT_KEYS_ENABLE'):
+        from .hotkeys import HotKeys
+        app.extensions['hot_keys'] = HotKeys(
+            app,
+            interval=app.config.get('HOT_KEYS_INTERVAL'),
+            count=app.config.get('HOT_KEYS_COUNT'),
+            path=app.config.get('HOT_KEYS_PATH'),
+        )
+        app.extensions['hot_keys'].start()
+
+    if app.config.get('CHANGE_FEED_ENABLE'):
+        from .changefeed import ChangeFeed
+        app.extensions['change_feed'] = ChangeFeed(
+            app,
+            interval=app.config.get('CHANGE_FEED_INTERVAL'),
+            lookback=app.config.get('CHANGE_FEED_LOOKBACK'),
+        )
+        app.extensions['change_feed'].start()
+
+    if app.config.get('USAGE_METERING_ENABLE'):
+        from .usage import UsageMeter
+        app.extensions['usage_meter'] = UsageMeter(
+            app,
+            interval=app.config.get('USAGE_FLUSH_INTERVAL'),
+            max_origins=app.config.get('USAGE_MAX_ORIGINS'),
+        )
+        app.extensions['usage_meter'].start()
+
+    if app.config.get('RATE_LIMIT_ENABLE'):
+        from .ratelimit import RateLimiter
+        app.extensions['rate_limiter'] = RateLimiter(
+            app,
+            window=app.config.get('RATE_LIMIT_WINDOW'),
+            sync_interval=app.config.get('RATE_LIMIT_SYNC_INTERVAL'),
+        )
+        app.extensions['rate_limiter'].start()
 
     csrf.init_app(app)
     bootstrap.init_app(app)
@@ -43,12 +109,12 @@ def create_app(config_name):
     sentry = None
     if app.config.get('SENTRY_ENABLE'):
         app.logger.info("Using Sentry")
-        from raven.contrib.flask import Sentry
-        sentry = Sentry(app)
-
-    @app.template_filter('from_millis')
-    def _timestamp_to_datetime_filter(ts_millis):
-        return datetime.datetime.fromtimestamp(ts_millis / 1000)
+        if app.config.get('LAZY_STARTUP'):
+            from .sentry import LazySentry
+            sentry = LazySentry(app)
+        else:
+            from raven.contrib.flask import Sentry
+            sentry = Sentry(app)
 
     @app.template_filter('nice_datetime')
     def _datetime_format_filter(dt):
@@ -100,6 +166,9 @@ def create_app(config_name):
     def humanize(dt):
         return dt.strftime(app.config.get('DATE_FORMAT'))
 
+    from .commands import register_commands
+    register_commands(app)
+
     from .apikey import keys_bp
     app.register_blueprint(keys_bp)
 
@@ -8,7 +8,8 @@ from flask import (
     url_for,
 )
 from . import admin_bp
-from ..storage import ApiKey, User, validate_allowed_origins
+from .. import bulk, usage
+from ..storage import ApiKey, User, search_index, storage_backend, storage_executor, unit_of_work, validate_allowed_origins
 from flask_login import current_user, login_required
 
 
@@ -17,13 +18,35 @@ def current_user_is_admin():
     return current_user and current_user.social_id in current_app.config.get('ADMIN_WHITELIST')
 
 
+# Number of days of usage shown on the admin pages
+USAGE_DAYS = 7
+
+# Number of search results loaded and shown per page
+SEARCH_PAGE_SIZE = 100
+
+
+# Flash a message listing any keys a bulk action failed on, returning true if
+# there were none
+def flash_bulk_errors(results):
+    failed = [api_key for api_key, error in results if error]
+    if failed:
+        flash("These API keys couldn't be updated, please try again: %s" % ', '.join(sorted(failed)))
+    return not failed
+
+
 @admin_bp.route('/admin')
 @login_required
 def index():
     if not current_user_is_admin():
         return redirect(url_for('apikey.mine'))
 
-    return render_template('admin/index.html')
+    return render_template(
+        'admin/index.html',
+        cache_stats=dict(
+            current_app.extensions['key_cache'].stats(),
+            coalesced_loads=current_app.extensions['key_loads'].coalesced,
+        ),
+    )
 
 @admin_bp.route('/admin/by_key', methods=['POST'])
 @login_required
@@ -41,6 +64,53 @@ def get_by_key():
 
     return redirect(url_for('admin.show_key', apikey=k.api_key))
 
+# The secondary index, normalized search term, and kind of result for each
+# search the admin can make
+SEARCHES = {
+    'email': ('user_email', lambda q: q.strip().lower(), 'user'),
+    'key_name': ('key_name', lambda q: q.strip().lower(), 'key'),
+    'locked_users': ('user_state', lambda q: 'admin_locked', 'user'),
+    'locked_keys': ('key_state', lambda q: 'admin_locked', 'key'),
+    'disabled_keys': ('key_state', lambda q: 'disabled', 'key'),
+}
+
+
+@admin_bp.route('/admin/search')
+@login_required
+def search():
+    if not current_user_is_admin():
+        return redirect(url_for('apikey.mine'))
+
+    by = request.args.get('by')
+    q = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+
+    if by not in SEARCHES:
+        flash("Please pick something to search by.")
+        return redirect(url_for('admin.index'))
+
+    index_name, normalize, kind = SEARCHES[by]
+    term = normalize(q)
+    ids = search_index(index_name, term)
+    page_ids = ids[(page - 1) * SEARCH_PAGE_SIZE:page * SEARCH_PAGE_SIZE]
+
+    # Index entries can be out of date, so only objects that still have the
+    # term are shown
+    clz = User if kind == 'user' else ApiKey
+    results = [obj for obj in clz.get_many(page_ids).values() if obj and term in obj.index_terms()[index_name]]
+
+    return render_template(
+        'admin/search.html',
+        by=by,
+        q=q,
+        kind=kind,
+        results=results,
+        page=page,
+        total=len(ids),
+        has_next=page * SEARCH_PAGE_SIZE < len(ids),
+    )
+
+
 @admin_bp.route('/admin/keys/<apikey>', methods=['GET', 'POST'])
 @login_required
 def show_key(apikey):
@@ -56,74 +126,87 @@ def show_key(apikey):
     u = User.get_by_user_id(k.person_id)
 
     if request.method == 'POST':
-        if request.form.get('action') == 'save':
-            new_name = request.form.get('name')
-            k.name = new_name
-
-            new_allowed_origins = request.form.get('allowed_origins')
-            if not validate_allowed_origins(new_allowed_origins):
-                flash("Please enter one origin URL per line or empty the box completely")
-                return redirect(url_for('admin.show_key', apikey=apikey))
-
-            if new_allowed_origins.strip():
-                k.allowed_origins = new_allowed_origins.strip().splitlines()
-            else:
-                k.allowed_origins = None
-
-            k.save()
-            u.api_keys[k.api_key] = k.as_dict()
-            u.save()
+        with unit_of_work():
+            if request.form.get('action') == 'save':
+                new_name = request.form.get('name')
+                k.name = new_name
 
-            flash("The details for this key were saved.")
-        elif request.form.get('action') == 'disable':
-            k.enabled = False
-            k.save()
-            u.api_keys[k.api_key] = k.as_dict()
-            u.save()
+                new_allowed_origins = request.form.get('allowed_origins')
+                if not validate_allowed_origins(new_allowed_origins):
+                    flash("Please enter one origin URL per line or empty the box completely")
+                    return redirect(url_for('admin.show_key', apikey=apikey))
 
-            flash("This API key was disabled and will stop allowing requests after a few minutes.")
-        elif request.form.get('action') == 'admin_lock':
-            k.admin_locked = True
-            k.admin_lock_user = current_user.get_id()
-            k.admin_lock_reason = request.form.get('user_lock_reason')
-            k.admin_lock_at = datetime.datetime.utcnow()
-            k.save()
-            u.api_keys[k.api_key] = k.as_dict()
-            u.save()
+                if new_allowed_origins.strip():
+                    k.allowed_origins = new_allowed_origins.strip().splitlines()
+                else:
+                    k.allowed_origins = None
 
-            flash("This API key has been locked. Its owner will not be able to enable it.")
-        elif request.form.get('action') == 'admin_unlock':
-            k.admin_locked = False
-            k.admin_lock_at = None
-            k.admin_lock_reason = None
-            k.admin_lock_user = None
-            k.save()
-            u.api_keys[k.api_key] = k.as_dict()
-            u.save()
+                new_rate_limit = request.form.get('rate_limit', '').strip()
+                if new_rate_limit and (not new_rate_limit.isdigit() or int(new_rate_limit) < 1):
+                    flash("Please enter a whole number of requests for the rate limit or empty the box completely")
+                    return redirect(url_for('admin.show_key', apikey=apikey))
 
-            flash("This API key has been unlocked. Its owner will now be able to enable it.")
-        elif request.form.get('action') == 'enable':
-            k.enabled = True
-            k.save()
-            u.api_keys[k.api_key] = k.as_dict()
-            u.save()
+                k.rate_limit = int(new_rate_limit) if new_rate_limit else None
 
-            flash("This API key was enabled and will start allowing requests after a few minutes.")
-        elif request.form.get('action') == 'delete':
-            if k.enabled:
-                flash("Please disable the key before attempting to delete it.")
-                return redirect(url_for('admin.show_key', apikey=apikey))
+                k.save()
+                u.api_keys[k.api_key] = k.summary()
+                u.save()
 
-            k.delete()
-            u.api_keys.pop(k.api_key, None)
-            u.save()
+                flash("The details for this key were saved.")
+            elif request.form.get('action') == 'disable':
+                k.enabled = False
+                k.save()
+                u.api_keys[k.api_key] = k.summary()
+                u.save()
 
-            flash("The API key %s was deleted." % apikey)
-            return redirect(url_for('admin.index'))
+                flash("This API key was disabled and will stop allowing requests after a few minutes.")
+            elif request.form.get('action') == 'admin_lock':
+                k.admin_locked = True
+                k.admin_lock_user = current_user.get_id()
+                k.admin_lock_reason = request.form.get('user_lock_reason')
+                k.admin_lock_at = datetime.datetime.utcnow()
+                k.save()
+                u.api_keys[k.api_key] = k.summary()
+                u.save()
 
-        return redirect(url_for('admin.show_key', apikey=apikey))
+                flash("This API key has been locked. Its owner will not be able to enable it.")
+            elif request.form.get('action') == 'admin_unlock':
+                k.admin_locked = False
+                k.admin_lock_at = None
+                k.admin_lock_reason = None
+                k.admin_lock_user = None
+                k.save()
+                u.api_keys[k.api_key] = k.summary()
+                u.save()
+
+                flash("This API key has been unlocked. Its owner will now be able to enable it.")
+            elif request.form.get('action') == 'enable':
+                k.enabled = True
+                k.save()
+                u.api_keys[k.api_key] = k.summary()
+                u.save()
+
+                flash("This API key was enabled and will start allowing requests after a few minutes.")
+            elif request.form.get('action') == 'delete':
+                if k.enabled:
+                    flash("Please disable the key before attempting to delete it.")
+                    return redirect(url_for('admin.show_key', apikey=apikey))
 
-    return render_template('admin/show_key.html', key=k, user=u)
+                k.delete()
+                u.api_keys.pop(k.api_key, None)
+                u.save()
+
+                flash("The API key %s was deleted." % apikey)
+                return redirect(url_for('admin.index'))
+
+            return redirect(url_for('admin.show_key', apikey=apikey))
+
+    return render_template(
+        'admin/show_key.html',
+        key=k,
+        user=u,
+        usage=usage.usage_for_key(storage_backend(), k.api_key, USAGE_DAYS),
+    )
 
 
 @admin_bp.route('/admin/users/<userid>', methods=['GET', 'POST'])
@@ -158,52 +241,40 @@ def show_user(userid):
             flash("This user's account has been unlocked. They will now be able to create API keys.")
 
         elif request.form.get('action') == 'disable_keys':
-            for api_key in u.api_keys.values():
-                k = ApiKey.from_dict(api_key)
-                k.enabled = False
-                k.save()
-                u.api_keys[k.api_key] = k.as_dict()
-            u.save()
-
-            flash("This user's API keys were all disabled and will stop allowing requests after a few minutes.")
+            if flash_bulk_errors(bulk.update_keys(u, 'disable')):
+                flash("This user's API keys were all disabled and will stop allowing requests after a few minutes.")
 
         elif request.form.get('action') == 'enable_keys':
-            for api_key in u.api_keys.values():
-                k = ApiKey.from_dict(api_key)
-                k.enabled = True
-                k.save()
-                u.api_keys[k.api_key] = k.as_dict()
-            u.save()
-
-            flash("This user's API keys were all enabled and will start allowing requests after a few minutes.")
+            if flash_bulk_errors(bulk.update_keys(u, 'enable')):
+                flash("This user's API keys were all enabled and will start allowing requests after a few minutes.")
 
         elif request.form.get('action') == 'lock_keys':
-            now = datetime.datetime.utcnow()
-            for api_key in u.api_keys.values():
-                k = ApiKey.from_dict(api_key)
-                k.admin_locked = True
-                k.admin_lock_user = current_user.get_id()
-                k.admin_lock_reason = request.form.get('key_lock_reason')
-                k.admin_lock_at = now
-                k.save()
-                u.api_keys[k.api_key] = k.as_dict()
-            u.save()
-
-            flash("This user's API keys were all locked. The user will not be able to enable them if they are disabled.")
+            results = bulk.update_keys(
+                u,
+                'lock',
+                lock_user=current_user.get_id(),
+                reason=request.form.get('key_lock_reason'),
+            )
+            if flash_bulk_errors(results):
+                flash("This user's API keys were all locked. The user will not be able to enable them if they are disabled.")
 
         elif request.form.get('action') == 'unlock_keys':
-            for api_key in u.api_keys.values():
-                k = ApiKey.from_dict(api_key)
-                k.admin_locked = False
-                k.admin_lock_at = None
-                k.admin_lock_reason = None
-                k.admin_lock_user = None
-                k.save()
-                u.api_keys[k.api_key] = k.as_dict()
-            u.save()
-
-            flash("This user's API key were all unlocked. The user will now be able to re-enable them if they are disabled.")
+            if flash_bulk_errors(bulk.update_keys(u, 'unlock')):
+                flash("This user's API key were all unlocked. The user will now be able to re-enable them if they are disabled.")
 
         return redirect(url_for('admin.show_user', userid=userid))
 
-    return render_template('admin/show_user.html', user=u)
+    keys = u.get_api_keys()
+    backend = storage_backend()
+    totals = storage_executor().map(
+        lambda k: sum(total for _, total, _ in usage.usage_for_key(backend, k.api_key, USAGE_DAYS)),
+        keys,
+    )
+
+    return render_template(
+        'admin/show_user.html',
+        user=u,
+        keys=keys,
+        usage_days=USAGE_DAYS,
+        usage_totals=dict(zip((k.api_key for k in keys), totals)),
+    )
@@ -1,17 +1,22 @@
 from flask import (
+    Response,
     current_app,
     flash,
+    json,
     jsonify,
     make_response,
     redirect,
     render_template,
     request,
+    stream_with_context,
     url_for,
 )
 from flask_login import current_user, login_required
 from . import keys_bp
+from .. import csrf, snapshot
 from ..admin.views import current_user_is_admin
-from ..storage import ApiKey, validate_allowed_origins
+from ..storage import ApiKey, unit_of_work, validate_allowed_origins
+from ..verify import CACHE_CONTROL_SETTINGS, STATUS_CODES, VALID, verdict_as_dict, verdict_etag, verdict_for
 
 
 @keys_bp.route('/robots.txt')
@@ -41,6 +46,7 @@ def contact():
 def mine():
     return render_template(
         'apikey/mine.html',
+        keys=current_user.get_api_keys(),
         disable_api_key_creation=(not current_user_is_admin() and current_app.config.get('DISABLE_USER_API_KEY_CREATION')),
     )
 
@@ -52,13 +58,14 @@ def create():
         flash("You cannot create a new API key because your account was locked by an admin.")
         return redirect(url_for('apikey.mine'))
 
-    if current_app.config.DISABLE_API_KEY_CREATION and not current_user_is_admin():
+    if current_app.config.get('DISABLE_USER_API_KEY_CREATION') and not current_user_is_admin():
         flash("You cannot create a new API key because the feature is disabled.")
         return redirect(url_for('apikey.mine'))
 
-    k = current_user.generate_random_key()
-    k.save()
-    current_user.save()
+    with unit_of_work():
+        k = current_user.generate_random_key()
+        k.save()
+        current_user.save()
     flash('You created a new API key!', 'success')
 
     return redirect(url_for('apikey.show', apikey=k.api_key))
@@ -78,58 +85,68 @@ def show(apikey):
         return redirect(url_for('apikey.mine'))
 
     if request.method == 'POST':
-        if request.form.get('action') == 'save':
-            new_name = request.form.get('name')
-            k.name = new_name
-
-            new_allowed_origins = request.form.get('allowed_origins')
-            if not validate_allowed_origins(new_allowed_origins):
-                flash("Please enter one origin URL per line or empty the box completely")
-                return redirect(url_for('apikey.show', apikey=apikey))
-
-            if new_allowed_origins.strip():
-                k.allowed_origins = new_allowed_origins.strip().splitlines()
-            else:
-                k.allowed_origins = None
-
-            k.save()
-            current_user.api_keys[k.api_key] = k.as_dict()
-            current_user.save()
-
-            flash("The details for this key were saved.")
-        elif request.form.get('action') == 'disable':
-            k.enabled = False
-            k.save()
-            current_user.api_keys[k.api_key] = k.as_dict()
-            current_user.save()
-
-            flash("This API key was disabled and will stop allowing requests after a few minutes.")
-        elif request.form.get('action') == 'enable':
-            k.enabled = True
-            k.save()
-            current_user.api_keys[k.api_key] = k.as_dict()
-            current_user.save()
-
-            flash("This API key was enabled and will start allowing requests after a few minutes.")
-        elif request.form.get('action') == 'delete':
-            if k.enabled:
-                flash("Please disable the key before attempting to delete it.")
-                return redirect(url_for('apikey.show', apikey=apikey))
-
-            k.delete()
-            current_user.api_keys.pop(k.api_key, None)
-            current_user.save()
-
-            flash("This API key %s was deleted." % apikey)
-            return redirect(url_for('apikey.mine'))
-
-        return redirect(url_for('apikey.show', apikey=apikey))
+        with unit_of_work():
+            if request.form.get('action') == 'save':
+                new_name = request.form.get('name')
+                k.name = new_name
+
+                new_allowed_origins = request.form.get('allowed_origins')
+                if not validate_allowed_origins(new_allowed_origins):
+                    flash("Please enter one origin URL per line or empty the box completely")
+                    return redirect(url_for('apikey.show', apikey=apikey))
+
+                if new_allowed_origins.strip():
+                    k.allowed_origins = new_allowed_origins.strip().splitlines()
+                else:
+                    k.allowed_origins = None
+
+                k.save()
+                current_user.api_keys[k.api_key] = k.summary()
+                current_user.save()
+
+                flash("The details for this key were saved.")
+            elif request.form.get('action') == 'disable':
+                k.enabled = False
+                k.save()
+                current_user.api_keys[k.api_key] = k.summary()
+                current_user.save()
+
+                flash("This API key was disabled and will stop allowing requests after a few minutes.")
+            elif request.form.get('action') == 'enable':
+                k.enabled = True
+                k.save()
+                current_user.api_keys[k.api_key] = k.summary()
+                current_user.save()
+
+                flash("This API key was enabled and will start allowing requests after a few minutes.")
+            elif request.form.get('action') == 'delete':
+                if k.enabled:
+                    flash("Please disable the key before attempting to delete it.")
+                    return redirect(url_for('apikey.show', apikey=apikey))
+
+                k.delete()
+                current_user.api_keys.pop(k.api_key, None)
+                current_user.save()
+
+                flash("This API key %s was deleted." % apikey)
+                return redirect(url_for('apikey.mine'))
+
+            return redirect(url_for('apikey.show', apikey=apikey))
 
     return render_template(
         'apikey/show.html',
         key=k,
     )
 
+# Count a verify request's verdict, and count it against the key if the key
+# exists. Unknown keys aren't metered so junk keys can't grow the counters.
+def record_verify(k, origin, verdict):
+    current_app.extensions['metrics']['verify_verdicts_total'].inc(verdict=verdict)
+    meter = current_app.extensions.get('usage_meter')
+    if meter and k:
+        meter.record(k.api_key, origin, verdict)
+
+
 @keys_bp.route('/verify')
 def verify_key():
     apikey = request.args.get('api_key')
@@ -137,17 +154,98 @@ def verify_key():
     if not apikey:
         return jsonify(result='error', message='Specify a api_key query arg to check.'), 400
 
+    origin = request.args.get('origin')
     k = ApiKey.get_by_api_key(apikey)
+    verdict = verdict_for(k, origin, current_app.extensions.get('rate_limiter'))
+    record_verify(k, origin, verdict)
+
+    # Only successful verdicts can be revalidated, since conditional requests
+    # don't apply to error responses
+    if verdict == VALID:
+        etag = verdict_etag(verdict, apikey, origin, k)
+        if request.if_none_match.contains(etag):
+            resp = make_response('', 304)
+        else:
+            resp = jsonify(**verdict_as_dict(verdict))
+        resp.set_etag(etag)
+    else:
+        resp = jsonify(**verdict_as_dict(verdict))
+        resp.status_code = STATUS_CODES[verdict]
+
+    resp.headers['Cache-Control'] = current_app.config.get(CACHE_CONTROL_SETTINGS[verdict])
+    return resp
 
-    if not k:
-        return jsonify(result='error', message='Unknown API key.'), 400
 
-    if not k.enabled:
-        return jsonify(result='error', message='Disabled API key.'), 400
+# Items are checked before the response starts streaming, since a bad one
+# can't be reported once the status has been sent
+def _valid_batch_item(item):
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get('api_key'), str)
+        and (item.get('origin') is None or isinstance(item.get('origin'), str))
+    )
 
-    origin = request.args.get('origin')
 
-    if not k.is_origin_allowed(origin):
-        return jsonify(result='error', message='Origin is not allowed by API key.'), 400
+@keys_bp.route('/verify/batch', methods=['POST'])
+@csrf.exempt
+def verify_batch():
+    items = request.get_json(silent=True)
+
+    if isinstance(items, list) and len(items) > current_app.config.get('VERIFY_BATCH_MAX_ITEMS'):
+        return jsonify(result='error', message='Too many items in batch.'), 400
+
+    if not isinstance(items, list) or not all(_valid_batch_item(i) for i in items):
+        return jsonify(result='error', message='Send a JSON array of objects with api_key and origin strings.'), 400
+
+    chunk_size = current_app.config.get('VERIFY_BATCH_CHUNK_SIZE')
+    rate_limiter = current_app.extensions.get('rate_limiter')
+
+    def generate():
+        keys = {}
+        yield '['
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            keys.update(ApiKey.get_many(i['api_key'] for i in chunk if i['api_key'] not in keys))
 
-    return jsonify(result='success', message='Valid API key.')
+            for n, item in enumerate(chunk):
+                verdict = verdict_for(keys[item['api_key']], item.get('origin'), rate_limiter)
+                record_verify(keys[item['api_key']], item.get('origin'), verdict)
+                result = dict(verdict_as_dict(verdict), api_key=item['api_key'], origin=item.get('origin'))
+                yield (',' if start + n else '') + json.dumps(result)
+        yield ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@keys_bp.route('/snapshot')
+def key_snapshot():
+    token = current_app.config.get('SNAPSHOT_ACCESS_TOKEN')
+    if not token:
+        return jsonify(result='error', message='Snapshots are not enabled.'), 404
+    if request.headers.get('Authorization') != 'Bearer %s' % token:
+        return jsonify(result='error', message='Invalid snapshot access token.'), 403
+
+    since = request.args.get('since', type=int)
+    body = snapshot.export(since)
+
+    if body is None:
+        return jsonify(result='error', message='No snapshot has been built yet.'), 404
+
+    resp = make_response(body)
+    resp.headers['Content-Type'] = 'application/octet-stream'
+    resp.headers['Cache-Control'] = current_app.config.get('SNAPSHOT_CACHE_CONTROL')
+    return resp
+
+
+@keys_bp.route('/metrics')
+def metrics():
+    token = current_app.config.get('METRICS_ACCESS_TOKEN')
+    if not token:
+        return jsonify(result='error', message='Metrics are not enabled.'), 404
+    if request.headers.get('Authorization') != 'Bearer %s' % token:
+        return jsonify(result='error', message='Invalid metrics access token.'), 403
+
+    resp = make_response(current_app.extensions['metrics'].render())
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
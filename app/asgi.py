@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from . import codec
+from .backends import create_backend
+from .cache import KeyCache
+from .config import config
+from .storage import ApiKey
+from .verify import CACHE_CONTROL_SETTINGS, STATUS_CODES, VALID, verdict_as_dict, verdict_etag, verdict_for
+
+# A standalone ASGI application that only answers /verify, for deploying next
+# to the Flask app without its sessions, CSRF, login and template machinery.
+#
+# It shares key parsing, origin matching and verdicts with the Flask app and
+# uses the same storage backend, key cache, usage meter, rate limiter and
+# change feed. Storage reads run on a thread pool so the event loop never
+# blocks, and concurrent requests for the same uncached key share one read.
+
+
+class VerifyService(object):
+    def __init__(self, config):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.extensions = {}
+        self.extensions['key_cache'] = KeyCache(
+            max_bytes=config.get('CACHE_MAX_BYTES'),
+            ttl=config.get('CACHE_TTL'),
+            soft_ttl=config.get('CACHE_SOFT_TTL'),
+            on_stale=self._refresh_key,
+            segments=config.get('CACHE_SEGMENTS'),
+            negative_maxsize=config.get('NEGATIVE_CACHE_SIZE'),
+            negative_ttl=config.get('NEGATIVE_CACHE_TTL'),
+        )
+        self.extensions['storage'] = create_backend(config)
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.get('STORAGE_MAX_WORKERS'),
+            thread_name_prefix='storage',
+        )
+        self.extensions['storage_executor'] = self.executor
+        self._loading = {}
+
+        if config.get('CACHE_PRELOAD_ENABLE'):
+            from .keystate import preload
+            try:
+                loaded = preload(self.extensions['storage'], self.extensions['key_cache'], config.get('CACHE_PRELOAD_MAX_AGE'))
+                self.logger.info("Preloaded %s keys into the cache", loaded)
+            except Exception:
+                self.logger.exception("Couldn't preload the key cache")
+
+        # The background workers only need .config, .extensions and .logger,
+        # so the service stands in for the Flask app
+        if config.get('CHANGE_FEED_ENABLE'):
+            from .changefeed import ChangeFeed
+            self.extensions['change_feed'] = ChangeFeed(
+                self,
+                interval=config.get('CHANGE_FEED_INTERVAL'),
+                lookback=config.get('CHANGE_FEED_LOOKBACK'),
+            )
+            self.extensions['change_feed'].start()
+
+        if config.get('USAGE_METERING_ENABLE'):
+            from .usage import UsageMeter
+            self.extensions['usage_meter'] = UsageMeter(
+                self,
+                interval=config.get('USAGE_FLUSH_INTERVAL'),
+                max_origins=config.get('USAGE_MAX_ORIGINS'),
+            )
+            self.extensions['usage_meter'].start()
+
+        if config.get('RATE_LIMIT_ENABLE'):
+            from .ratelimit import RateLimiter
+            self.extensions['rate_limiter'] = RateLimiter(
+                self,
+                window=config.get('RATE_LIMIT_WINDOW'),
+                sync_interval=config.get('RATE_LIMIT_SYNC_INTERVAL'),
+            )
+            self.extensions['rate_limiter'].start()
+
+    # Runs on the storage thread pool
+    def _load_key(self, api_key):
+        cache = self.extensions['key_cache']
+        cache_key = 'key.%s' % api_key
+        body = self.extensions['storage'].get_object(ApiKey.collection, api_key)
+
+        if body is None:
+            cache.set_negative(cache_key)
+            return None
+
+        k = ApiKey.from_dict(codec.decode(body))
+        cache.set(cache_key, k)
+        return k
+
+    def _refresh_key(self, cache_key):
+        def refresh():
+            try:
+                self._load_key(cache_key.split('.', 1)[1])
+            except Exception:
+                self.logger.exception("Couldn't refresh %s", cache_key)
+
+        self.executor.submit(refresh)
+
+    async def get_key(self, api_key):
+        found, k = self.extensions['key_cache'].get('key.%s' % api_key)
+        if found:
+            return k
+
+        future = self._loading.get(api_key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self._load_key, api_key)
+            self._loading[api_key] = future
+            future.add_done_callback(lambda f: self._loading.pop(api_key, None))
+
+        # A client disconnecting mustn't cancel the read for everyone else
+        return await asyncio.shield(future)
+
+    async def verify(self, query, headers):
+        args = parse_qs(query.decode('latin-1'))
+        api_key = args.get('api_key', [None])[0]
+
+        if not api_key:
+            return 400, {'result': 'error', 'message': 'Specify a api_key query arg to check.'}, []
+
+        origin = args.get('origin', [None])[0]
+        k = await self.get_key(api_key)
+        verdict = verdict_for(k, origin, self.extensions.get('rate_limiter'))
+
+        meter = self.extensions.get('usage_meter')
+        if meter and k:
+            meter.record(k.api_key, origin, verdict)
+
+        extra = [(b'cache-control', self.config.get(CACHE_CONTROL_SETTINGS[verdict]).encode('latin-1'))]
+        status = STATUS_CODES[verdict]
+
+        if verdict == VALID:
+            etag = '"%s"' % verdict_etag(verdict, api_key, origin, k)
+            extra.append((b'etag', etag.encode('latin-1')))
+            if_none_match = headers.get(b'if-none-match', b'').decode('latin-1')
+            tags = [t.strip() for t in if_none_match.split(',')]
+            if etag in tags or '*' in tags:
+                return 304, None, extra
+
+        return status, verdict_as_dict(verdict), extra
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] != 'http':
+            return
+
+        if scope['path'] != '/verify':
+            status, body, extra = 404, {'result': 'error', 'message': 'Not found.'}, []
+        elif scope['method'] not in ('GET', 'HEAD'):
+            status, body, extra = 405, {'result': 'error', 'message': 'Method not allowed.'}, [(b'allow', b'GET, HEAD')]
+        else:
+            try:
+                status, body, extra = await self.verify(scope['query_string'], dict(scope['headers']))
+            except Exception:
+                self.logger.exception("Couldn't verify key")
+                status, body, extra = 500, {'result': 'error', 'message': 'Internal server error.'}, []
+
+        headers = [(b'server', b'Server')] + extra
+        payload = b''
+        if body is not None:
+            payload = json.dumps(body).encode('utf8')
+            headers.append((b'content-type', b'application/json'))
+        headers.append((b'content-length', str(len(payload)).encode('latin-1')))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else payload})
+
+
+def create_service(config_name):
+    config_class = config[config_name]
+    return VerifyService(dict((name, getattr(config_class, name)) for name in dir(config_class) if name.isupper()))
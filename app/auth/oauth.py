@@ -1,4 +1,3 @@
-from rauth import OAuth2Service
 from flask import current_app, url_for, request, redirect, json
 
 
@@ -17,28 +16,40 @@ class OAuthSignIn(object):
     def callback(self):
         pass
 
+    # rauth pulls in requests, so it is only imported once a provider is used
+    def make_service(self, **kwargs):
+        from rauth import OAuth2Service
+        return OAuth2Service(
+            name=self.provider_name,
+            client_id=self.consumer_id,
+            client_secret=self.consumer_secret,
+            **kwargs
+        )
+
     def get_callback_url(self):
         return url_for('auth.oauth_callback',
                        provider=self.provider_name,
                        _external=True)
 
+    # Providers are only constructed when they are first asked for, so a
+    # request only pays for the one it uses
     @classmethod
     def get_provider(self, provider_name):
         if self.providers is None:
             self.providers = {}
+        if provider_name not in self.providers:
             for provider_class in self.__subclasses__():
-                provider = provider_class()
-                self.providers[provider.provider_name] = provider
+                if provider_class.name == provider_name:
+                    self.providers[provider_name] = provider_class()
         return self.providers[provider_name]
 
 
 class FacebookSignIn(OAuthSignIn):
+    name = 'facebook'
+
     def __init__(self):
-        super(FacebookSignIn, self).__init__('facebook')
-        self.service = OAuth2Service(
-            name='facebook',
-            client_id=self.consumer_id,
-            client_secret=self.consumer_secret,
+        super(FacebookSignIn, self).__init__(self.name)
+        self.service = self.make_service(
             authorize_url='https://graph.facebook.com/oauth/authorize',
             access_token_url='https://graph.facebook.com/oauth/access_token',
             base_url='https://graph.facebook.com/'
@@ -69,12 +80,11 @@ class FacebookSignIn(OAuthSignIn):
 
 
 class GoogleSignIn(OAuthSignIn):
+    name = 'google'
+
     def __init__(self):
-        super(GoogleSignIn, self).__init__('google')
-        self.service = OAuth2Service(
-            name='google',
-            client_id=self.consumer_id,
-            client_secret=self.consumer_secret,
+        super(GoogleSignIn, self).__init__(self.name)
+        self.service = self.make_service(
             authorize_url='https://accounts.google.com/o/oauth2/v2/auth',
             base_url='https://www.googleapis.com/oauth2/v3/userinfo',
             access_token_url='https://www.googleapis.com/oauth2/v4/token'
@@ -109,12 +119,11 @@ class GoogleSignIn(OAuthSignIn):
 
 
 class GithubSignIn(OAuthSignIn):
+    name = 'github'
+
     def __init__(self):
-        super(GithubSignIn, self).__init__('github')
-        self.service = OAuth2Service(
-            name='github',
-            client_id=self.consumer_id,
-            client_secret=self.consumer_secret,
+        super(GithubSignIn, self).__init__(self.name)
+        self.service = self.make_service(
             authorize_url='https://github.com/login/oauth/authorize',
             access_token_url='https://github.com/login/oauth/access_token',
             base_url='https://api.github.com/'
@@ -1,5 +1,4 @@
 import datetime
-import requests
 from flask import (
     current_app,
     flash,
@@ -98,6 +97,7 @@ def oauth_callback(provider):
 
         if current_app.config.get('SLACK_WEBHOOK_URL'):
             try:
+                import requests
                 webhook_url = current_app.config.get('SLACK_WEBHOOK_URL')
                 resp = requests.post(webhook_url, json={"text": "New user `%s` (`%s`) joined!" % (social_id, email)})
                 resp.raise_for_status()
@@ -0,0 +1,284 @@
+import logging
+import posixpath
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend(object):
+    # Whether put_object_if is atomic. Where it isn't, it writes
+    # unconditionally and always returns true.
+    conditional_writes = True
+
+    def get_object(self, collection, name):
+        raise NotImplementedError()
+
+    def put_object(self, collection, name, body, content_type='application/json'):
+        raise NotImplementedError()
+
+    def delete_object(self, collection, name):
+        raise NotImplementedError()
+
+    def delete_objects(self, collection, names):
+        raise NotImplementedError()
+
+    # Returns (body, version), or (None, None) if there is no such object.
+    # The version is opaque and only meant for put_object_if.
+    def get_object_version(self, collection, name):
+        raise NotImplementedError()
+
+    # Write an object only if it is still at `version`, or still missing if
+    # `version` is None. Returns whether it was written.
+    def put_object_if(self, collection, name, body, version, content_type='application/json'):
+        raise NotImplementedError()
+
+    # Yields the names in a collection in sorted order, optionally only those
+    # after `start_after`
+    def list_objects(self, collection, start_after=None):
+        raise NotImplementedError()
+
+
+# Stores each object at <prefix>/<collection>/<name> in an S3 bucket. A
+# single client is shared by every thread so its connection pool stays warm.
+# `client_config` holds botocore Config options. With `lazy`, boto3 is only
+# imported and the client built when storage is first used.
+#
+# Conditional writes need botocore 1.35.69 or later, the first release whose
+# PutObject takes IfMatch and IfNoneMatch.
+class S3Backend(StorageBackend):
+    def __init__(self, bucket, prefix='', client_config=None, lazy=False):
+        self.bucket = bucket
+        self.prefix = prefix or ''
+        self.client_config = client_config
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._conditional_writes = None
+        if not lazy:
+            self._client = self._make_client()
+
+    def _make_client(self):
+        import boto3
+        from botocore.config import Config as BotoConfig
+        config = BotoConfig(**self.client_config) if self.client_config else None
+        return boto3.session.Session().client('s3', config=config)
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._make_client()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+        self._conditional_writes = None
+
+    @property
+    def conditional_writes(self):
+        if self._conditional_writes is None:
+            members = self.client.meta.service_model.operation_model('PutObject').input_shape.members
+            self._conditional_writes = 'IfMatch' in members and 'IfNoneMatch' in members
+            if not self._conditional_writes:
+                logger.warning(
+                    "This botocore doesn't support conditional writes, so concurrent index updates from "
+                    "different processes can overwrite each other until `flask rebuild-indexes` runs")
+        return self._conditional_writes
+
+    def _key(self, collection, name):
+        return posixpath.join(self.prefix, collection, name)
+
+    def get_object(self, collection, name):
+        try:
+            res = self.client.get_object(
+                Bucket=self.bucket,
+                Key=self._key(collection, name),
+            )
+            return res['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def put_object(self, collection, name, body, content_type='application/json'):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._key(collection, name),
+            Body=body,
+            ContentType=content_type,
+        )
+
+    def delete_object(self, collection, name):
+        self.client.delete_object(
+            Bucket=self.bucket,
+            Key=self._key(collection, name),
+        )
+
+    # S3 deletes up to 1000 objects per request
+    def delete_objects(self, collection, names):
+        for start in range(0, len(names), 1000):
+            res = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    'Objects': [{'Key': self._key(collection, name)} for name in names[start:start + 1000]],
+                    'Quiet': True,
+                },
+            )
+            if res.get('Errors'):
+                raise IOError("Couldn't delete %s objects from %s" % (len(res['Errors']), collection))
+
+    def get_object_version(self, collection, name):
+        try:
+            res = self.client.get_object(
+                Bucket=self.bucket,
+                Key=self._key(collection, name),
+            )
+            return res['Body'].read(), res['ETag']
+        except self.client.exceptions.NoSuchKey:
+            return None, None
+
+    def put_object_if(self, collection, name, body, version, content_type='application/json'):
+        if not self.conditional_writes:
+            self.put_object(collection, name, body, content_type)
+            return True
+
+        condition = {'IfMatch': version} if version else {'IfNoneMatch': '*'}
+        try:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self._key(collection, name),
+                Body=body,
+                ContentType=content_type,
+                **condition
+            )
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+    def list_objects(self, collection, start_after=None):
+        prefix = self._key(collection, '')
+        kwargs = {}
+        if start_after:
+            kwargs['StartAfter'] = prefix + start_after
+
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, **kwargs):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(prefix):]
+
+
+# Stores objects in a local SQLite database, indexed on (collection, name).
+# Each thread gets its own connection and the database runs in WAL mode so
+# readers never block on a writer.
+class SQLiteBackend(StorageBackend):
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+                uri=self.path.startswith('file:'),
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                ' collection TEXT NOT NULL,'
+                ' name TEXT NOT NULL,'
+                ' body BLOB NOT NULL,'
+                ' content_type TEXT,'
+                ' PRIMARY KEY (collection, name)'
+                ') WITHOUT ROWID'
+            )
+            self._local.conn = conn
+        return conn
+
+    def get_object(self, collection, name):
+        row = self._connect().execute(
+            'SELECT body FROM objects WHERE collection = ? AND name = ?',
+            (collection, name),
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def put_object(self, collection, name, body, content_type='application/json'):
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        self._connect().execute(
+            'INSERT OR REPLACE INTO objects (collection, name, body, content_type) VALUES (?, ?, ?, ?)',
+            (collection, name, body, content_type),
+        )
+
+    def delete_object(self, collection, name):
+        self._connect().execute(
+            'DELETE FROM objects WHERE collection = ? AND name = ?',
+            (collection, name),
+        )
+
+    def delete_objects(self, collection, names):
+        self._connect().executemany(
+            'DELETE FROM objects WHERE collection = ? AND name = ?',
+            [(collection, name) for name in names],
+        )
+
+    # An object's body is its version, so a conditional write is one
+    # compare-and-swap statement
+    def get_object_version(self, collection, name):
+        body = self.get_object(collection, name)
+        return body, body
+
+    def put_object_if(self, collection, name, body, version, content_type='application/json'):
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        if version is None:
+            cursor = self._connect().execute(
+                'INSERT OR IGNORE INTO objects (collection, name, body, content_type) VALUES (?, ?, ?, ?)',
+                (collection, name, body, content_type),
+            )
+        else:
+            cursor = self._connect().execute(
+                'UPDATE objects SET body = ?, content_type = ? WHERE collection = ? AND name = ? AND body = ?',
+                (body, content_type, collection, name, version),
+            )
+        return cursor.rowcount == 1
+
+    def list_objects(self, collection, start_after=None):
+        rows = self._connect().execute(
+            'SELECT name FROM objects WHERE collection = ? AND name > ? ORDER BY name',
+            (collection, start_after or ''),
+        )
+        for row in rows:
+            yield row[0]
+
+
+def create_backend(config):
+    backend = config.get('STORAGE_BACKEND')
+
+    if backend == 's3':
+        return S3Backend(
+            bucket=config.get('STORAGE_S3_BUCKET'),
+            prefix=config.get('STORAGE_S3_PREFIX'),
+            client_config=dict(
+                max_pool_connections=config.get('STORAGE_S3_MAX_POOL_CONNECTIONS'),
+                connect_timeout=config.get('STORAGE_S3_CONNECT_TIMEOUT'),
+                read_timeout=config.get('STORAGE_S3_READ_TIMEOUT'),
+                tcp_keepalive=config.get('STORAGE_S3_TCP_KEEPALIVE'),
+                retries={
+                    'mode': config.get('STORAGE_S3_RETRY_MODE'),
+                    'max_attempts': config.get('STORAGE_S3_MAX_ATTEMPTS'),
+                },
+            ),
+            lazy=config.get('LAZY_STARTUP'),
+        )
+    elif backend == 'sqlite':
+        return SQLiteBackend(config.get('STORAGE_SQLITE_PATH'))
+    else:
+        raise ValueError("Unknown storage backend %r" % backend)
@@ -0,0 +1,26 @@
+import atexit
+import threading
+import time
+
+
+# Start a daemon thread that calls `fn` every `interval` seconds, logging
+# `failure` with the traceback if a call raises. `first` is called once when
+# the thread starts. With `at_exit`, `fn` is also called when the process
+# exits, so work done since the last call isn't lost.
+def run_periodically(app, name, interval, fn, failure, first=None, at_exit=False):
+    def run():
+        if first:
+            first()
+
+        while True:
+            time.sleep(interval)
+            try:
+                fn()
+            except Exception:
+                app.logger.exception(failure)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    if at_exit:
+        atexit.register(fn)
+    return thread
@@ -0,0 +1,76 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import current_app
+from .storage import ApiKey
+
+
+def disable(k):
+    k.enabled = False
+
+
+def enable(k):
+    k.enabled = True
+
+
+def lock(k, lock_user=None, reason=None, at=None):
+    k.admin_locked = True
+    k.admin_lock_user = lock_user
+    k.admin_lock_reason = reason
+    k.admin_lock_at = at or datetime.datetime.utcnow()
+
+
+def unlock(k):
+    k.admin_locked = False
+    k.admin_lock_at = None
+    k.admin_lock_reason = None
+    k.admin_lock_user = None
+
+
+ACTIONS = {
+    'disable': disable,
+    'enable': enable,
+    'lock': lock,
+    'unlock': unlock,
+}
+
+
+# Apply a bulk action to every one of a user's API keys, saving the keys
+# concurrently on a bounded thread pool and then saving the user once.
+# Returns a list of (api_key, error) tuples, where error is None if that key
+# was updated.
+#
+# Keys are changed on copies, since get_many returns the cached instances
+# and a failed save mustn't leave its changes in the cache.
+def update_keys(user, action, **kwargs):
+    app = current_app._get_current_object()
+    change = ACTIONS[action]
+
+    def run(k):
+        with app.app_context():
+            k = ApiKey.from_dict(k.as_dict())
+            change(k, **kwargs)
+            k.save()
+            return k
+
+    results = []
+    keys = ApiKey.get_many(user.api_keys)
+    with ThreadPoolExecutor(max_workers=app.config.get('BULK_MAX_WORKERS')) as pool:
+        futures = {}
+        for api_key, k in keys.items():
+            if k:
+                futures[pool.submit(run, k)] = api_key
+            else:
+                results.append((api_key, LookupError("Key %s doesn't exist" % api_key)))
+
+        for future in as_completed(futures):
+            api_key = futures[future]
+            try:
+                k = future.result()
+                user.api_keys[api_key] = k.summary()
+                results.append((api_key, None))
+            except Exception as e:
+                app.logger.exception("Couldn't %s key %s", action, api_key)
+                results.append((api_key, e))
+
+    user.save()
+    return results
@@ -0,0 +1,284 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+
+# Estimates the real memory footprint of a cached object by following its
+# attributes and containers, rather than just measuring the outer object.
+def deep_getsizeof(obj):
+    seen = set()
+    size = 0
+    stack = [obj]
+
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, type):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        else:
+            if hasattr(o, '__dict__'):
+                stack.append(o.__dict__)
+            for slot in getattr(type(o), '__slots__', ()):
+                if hasattr(o, slot):
+                    stack.append(getattr(o, slot))
+
+    return size
+
+
+class _Entry(object):
+    __slots__ = ('value', 'size', 'refresh_at', 'expires_at', 'hits')
+
+    def __init__(self, value, size, refresh_at, expires_at, hits):
+        self.value = value
+        self.size = size
+        self.refresh_at = refresh_at
+        self.expires_at = expires_at
+        self.hits = hits
+
+
+class _Segment(object):
+    def __init__(self, max_bytes, negative_maxsize):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.negative_maxsize = negative_maxsize
+        self.currsize = 0
+        self.entries = {}
+        # Maps a key that is known not to exist to its expiry time
+        self.negative = {}
+        self.accesses = 0
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+
+
+# Caches User and ApiKey objects by storage key.
+#
+# Keys are spread over independently locked segments so concurrent request
+# threads rarely contend. Every entry expires after `ttl` seconds so changes
+# made by other processes are picked up. Entries are measured by their deep
+# size in bytes, and when a segment is over its share of `max_bytes` the least
+# frequently used of a small sample of its oldest entries is evicted. Hit
+# counts are periodically halved so keys that used to be popular eventually
+# age out.
+#
+# Lookups for objects that don't exist are remembered separately in a small,
+# short-lived negative cache so junk keys can never evict real entries.
+#
+# If `on_stale` is given, the first lookup of an entry older than `soft_ttl`
+# still returns it but also calls `on_stale(key)`, which should reload the
+# entry in the background. If the reload hasn't replaced the entry after
+# REFRESH_RETRY seconds, the next lookup asks again.
+class KeyCache(object):
+    EVICTION_SAMPLE = 8
+    AGING_PERIOD = 1000
+    REFRESH_RETRY = 5
+
+    def __init__(self, max_bytes, ttl, negative_maxsize, negative_ttl, segments=16,
+                 getsizeof=deep_getsizeof, timer=time.monotonic, soft_ttl=None, on_stale=None):
+        self.ttl = ttl
+        self.soft_ttl = soft_ttl if on_stale and soft_ttl is not None and soft_ttl < ttl else ttl
+        self.on_stale = on_stale
+        self.negative_ttl = negative_ttl
+        self._getsizeof = getsizeof
+        self._timer = timer
+        self._segments = [
+            _Segment(int(max_bytes // segments), max(1, int(negative_maxsize // segments)))
+            for _ in range(segments)
+        ]
+
+    def _segment(self, key):
+        return self._segments[hash(key) % len(self._segments)]
+
+    def _age(self, seg):
+        seg.accesses += 1
+        if seg.accesses >= max(self.AGING_PERIOD, 4 * len(seg.entries)):
+            seg.accesses = 0
+            for entry in seg.entries.values():
+                entry.hits >>= 1
+
+    def _remove(self, seg, key):
+        entry = seg.entries.pop(key, None)
+        if entry is not None:
+            seg.currsize -= entry.size
+        return entry
+
+    def _evict(self, seg):
+        victim = None
+        for key in itertools.islice(seg.entries, self.EVICTION_SAMPLE):
+            entry = seg.entries[key]
+            if victim is None or entry.hits < seg.entries[victim].hits:
+                victim = key
+        self._remove(seg, victim)
+        seg.evictions += 1
+
+    # Returns a (found, value) tuple. A found entry with a None value is a
+    # cached miss.
+    def get(self, key):
+        seg = self._segment(key)
+        now = self._timer()
+
+        with seg.lock:
+            entry = seg.entries.get(key)
+            if entry is not None:
+                if entry.expires_at > now:
+                    entry.hits += 1
+                    seg.hits += 1
+                    self._age(seg)
+                    stale = self.on_stale is not None and entry.refresh_at <= now
+                    if stale:
+                        entry.refresh_at = now + self.REFRESH_RETRY
+                        seg.refreshes += 1
+                    value = entry.value
+                else:
+                    self._remove(seg, key)
+                    seg.expirations += 1
+                    entry = None
+
+            if entry is None:
+                expires_at = seg.negative.get(key)
+                if expires_at is not None:
+                    if expires_at > now:
+                        seg.negative_hits += 1
+                        return True, None
+
+                    del seg.negative[key]
+
+                seg.misses += 1
+                return False, None
+
+        if stale:
+            self.on_stale(key)
+        return True, value
+
+    # A `stale` entry is refreshed on its first lookup, for values that may
+    # already be out of date, if the cache has an `on_stale` callback
+    def set(self, key, value, stale=False):
+        seg = self._segment(key)
+        size = self._getsizeof(value)
+        if size > seg.max_bytes:
+            return
+
+        with seg.lock:
+            seg.negative.pop(key, None)
+            old = self._remove(seg, key)
+            while seg.entries and seg.currsize + size > seg.max_bytes:
+                self._evict(seg)
+            now = self._timer()
+            seg.entries[key] = _Entry(
+                value,
+                size,
+                now if stale else now + self.soft_ttl,
+                now + self.ttl,
+                old.hits if old else 1,
+            )
+            seg.currsize += size
+
+    def set_negative(self, key):
+        seg = self._segment(key)
+
+        with seg.lock:
+            self._remove(seg, key)
+            seg.negative.pop(key, None)
+            while len(seg.negative) >= seg.negative_maxsize:
+                del seg.negative[next(iter(seg.negative))]
+            seg.negative[key] = self._timer() + self.negative_ttl
+
+    def pop(self, key):
+        seg = self._segment(key)
+
+        with seg.lock:
+            seg.negative.pop(key, None)
+            entry = self._remove(seg, key)
+            return entry.value if entry else None
+
+    # The `n` cached keys with the highest hit counts, most used first
+    def top(self, n):
+        candidates = []
+        for seg in self._segments:
+            with seg.lock:
+                candidates.extend(heapq.nlargest(n, ((e.hits, k) for k, e in seg.entries.items())))
+        return [key for hits, key in heapq.nlargest(n, candidates)]
+
+    def stats(self):
+        totals = {
+            'bytes': 0,
+            'max_bytes': 0,
+            'entries': 0,
+            'negative_entries': 0,
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'refreshes': 0,
+        }
+        for seg in self._segments:
+            with seg.lock:
+                totals['bytes'] += seg.currsize
+                totals['max_bytes'] += seg.max_bytes
+                totals['entries'] += len(seg.entries)
+                totals['negative_entries'] += len(seg.negative)
+                totals['hits'] += seg.hits
+                totals['misses'] += seg.misses
+                totals['negative_hits'] += seg.negative_hits
+                totals['evictions'] += seg.evictions
+                totals['expirations'] += seg.expirations
+                totals['refreshes'] += seg.refreshes
+        return totals
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Coalesces concurrent calls for the same key: the first caller runs the
+# function and every caller that arrives while it is running waits for it and
+# gets the same result, or has the same error raised.
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
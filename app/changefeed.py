@@ -0,0 +1,81 @@
+import time
+import uuid
+from .background import run_periodically
+
+PRUNE_BATCH_SIZE = 1000
+
+
+def _name_at(ts):
+    return '%013d' % int(ts * 1000)
+
+
+# An ordered log of cache keys changed by writes, shared by every process
+# through the storage backend. Each change is an empty object in the
+# `changes` collection named <millis>.<random>.<cache key>, so one listing is
+# enough to read everything written since a point in time.
+#
+# Each process polls the log every `interval` seconds and drops the changed
+# entries from its own cache. Listings start `lookback` seconds in the past to
+# tolerate clock skew between writers, and names already seen are skipped.
+#
+# Old changes are deleted by `flask prune-change-feed` (or a lifecycle rule
+# on the bucket), not by every polling process.
+class ChangeFeed(object):
+    def __init__(self, app, interval, lookback):
+        self.app = app
+        self.interval = interval
+        self.lookback = lookback
+        self._seen = {}
+        self._thread = None
+
+    @property
+    def backend(self):
+        return self.app.extensions['storage']
+
+    @property
+    def cache(self):
+        return self.app.extensions['key_cache']
+
+    def append(self, cache_key):
+        name = '%s.%s.%s' % (_name_at(time.time()), uuid.uuid4().hex[:8], cache_key)
+        self.backend.put_object('changes', name, b'', 'application/octet-stream')
+
+    def poll(self):
+        now = time.time()
+        start_after = _name_at(now - self.lookback)
+
+        for name in self.backend.list_objects('changes', start_after=start_after):
+            if name in self._seen:
+                continue
+
+            self._seen[name] = now
+            ts, _, cache_key = name.split('.', 2)
+            self.cache.pop(cache_key)
+
+        for name, seen_at in list(self._seen.items()):
+            if seen_at < now - self.lookback:
+                del self._seen[name]
+
+    def start(self):
+        self._thread = run_periodically(self.app, 'change-feed', self.interval, self.poll, "Couldn't poll the change feed")
+
+
+# Delete the changes written before `before`, a batch at a time. Returns how
+# many were deleted.
+def prune(backend, before):
+    cutoff = _name_at(before)
+    deleted = 0
+    batch = []
+    for name in backend.list_objects('changes'):
+        if name >= cutoff:
+            break
+        batch.append(name)
+        if len(batch) == PRUNE_BATCH_SIZE:
+            backend.delete_objects('changes', batch)
+            deleted += len(batch)
+            batch = []
+
+    if batch:
+        backend.delete_objects('changes', batch)
+        deleted += len(batch)
+    return deleted
@@ -0,0 +1,39 @@
+import json
+
+# Users and keys are stored as JSON, or as msgpack when STORAGE_CODEC is
+# 'msgpack', which is smaller and quicker to decode. Every document is a map,
+# and a msgpack map never starts with the same byte as a JSON object, so both
+# encodings can be read whatever the setting and existing JSON documents are
+# rewritten as msgpack the next time they are saved.
+#
+# msgpack is an optional dependency, imported only when it is used.
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+CONTENT_TYPES = {
+    JSON: 'application/json',
+    MSGPACK: 'application/msgpack',
+}
+
+
+def _is_msgpack(body):
+    first = body[0]
+    return 0x80 <= first <= 0x8f or first in (0xde, 0xdf)
+
+
+# Returns (body, content type)
+def encode(data, codec=JSON):
+    if codec == MSGPACK:
+        import msgpack
+        return msgpack.packb(data, use_bin_type=True), CONTENT_TYPES[MSGPACK]
+    elif codec == JSON:
+        return json.dumps(data, separators=(',', ':')), CONTENT_TYPES[JSON]
+    else:
+        raise ValueError("Unknown storage codec %r" % codec)
+
+
+def decode(body):
+    if _is_msgpack(body):
+        import msgpack
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body.decode('utf8'))
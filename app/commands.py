@@ -0,0 +1,88 @@
+import click
+import datetime
+import time
+from . import bulk, changefeed, codec, indexes, keystate, snapshot, usage
+from .storage import ApiKey, User, run_concurrently, storage_backend, storage_executor
+
+
+def register_commands(app):
+    @app.cli.command('build-snapshot')
+    def build_snapshot_command():
+        click.echo(snapshot.build())
+
+    @app.cli.command('build-key-state')
+    def build_key_state_command():
+        click.echo("Wrote %s keys" % keystate.build(storage_backend(), ApiKey.scan()))
+
+    # Rewrite user documents that still embed full copies of their keys so
+    # they only hold key summaries
+    @app.cli.command('migrate-users')
+    def migrate_users_command():
+        backend = storage_backend()
+
+        def migrate(user_id):
+            with app.app_context():
+                data = codec.decode(backend.get_object('users', user_id))
+                u = User.from_dict(data)
+                if data.get('api_keys', {}) == u.api_keys:
+                    return False
+                u.save()
+                return True
+
+        migrated = sum(storage_executor().map(migrate, backend.list_objects('users')))
+        click.echo("Migrated %s users" % migrated)
+
+    @app.cli.command('prune-change-feed')
+    def prune_change_feed_command():
+        deleted = changefeed.prune(storage_backend(), time.time() - app.config.get('CHANGE_FEED_RETENTION'))
+        click.echo("Deleted %s changes" % deleted)
+
+    @app.cli.command('rebuild-indexes')
+    def rebuild_indexes_command():
+        objects = [(u.user_id, u.index_terms()) for u in User.scan()]
+        objects.extend((k.api_key, k.index_terms()) for k in ApiKey.scan())
+        indexes.rebuild(storage_backend(), run_concurrently, objects)
+        click.echo("Indexed %s users and keys" % len(objects))
+
+    @app.cli.command('compact-usage')
+    @click.option('--date', 'dates', multiple=True, help='Day to compact as YYYY-MM-DD. Defaults to yesterday and today.')
+    def compact_usage_command(dates):
+        if not dates:
+            today = datetime.datetime.utcnow().date()
+            dates = [(today - datetime.timedelta(days=n)).strftime('%Y-%m-%d') for n in (1, 0)]
+
+        for date in dates:
+            merged = usage.compact(
+                storage_backend(),
+                run_concurrently,
+                date,
+                app.config.get('USAGE_RETAIN_DAYS'),
+                app.config.get('USAGE_MAX_ORIGINS'),
+            )
+            click.echo("%s: compacted %s batches" % (date, merged))
+
+    @app.cli.command('bulk-keys')
+    @click.argument('action', type=click.Choice(sorted(bulk.ACTIONS)))
+    @click.argument('user_ids', nargs=-1, required=True)
+    @click.option('--reason', help='Reason recorded when locking keys.')
+    @click.option('--lock-user', help='Admin user ID recorded when locking keys.')
+    def bulk_keys_command(action, user_ids, reason, lock_user):
+        kwargs = {}
+        if action == 'lock':
+            kwargs = {'lock_user': lock_user, 'reason': reason}
+
+        failed = 0
+        for user_id in user_ids:
+            u = User.get_by_user_id(user_id)
+            if not u:
+                click.echo("%s: no such user" % user_id)
+                failed += 1
+                continue
+
+            for api_key, error in bulk.update_keys(u, action, **kwargs):
+                if error:
+                    failed += 1
+                click.echo("%s %s: %s" % (user_id, api_key, error or 'ok'))
+
+        if failed:
+            raise click.ClickException("%s updates failed" % failed)
@@ -10,11 +10,108 @@ class Config:
     SLACK_WEBHOOK_URL = os.environ.get('SLACK_WEBHOOK_URL')
 
     BOTO3_SERVICES = ['s3']
+    # Either 's3' or 'sqlite'
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 's3')
     STORAGE_S3_BUCKET = os.environ.get('STORAGE_S3_BUCKET')
     STORAGE_S3_PREFIX = ''
+    # Tuning for the shared S3 client's connection pool, timeouts and retries
+    STORAGE_S3_MAX_POOL_CONNECTIONS = int(os.environ.get('STORAGE_S3_MAX_POOL_CONNECTIONS', 50))
+    STORAGE_S3_CONNECT_TIMEOUT = float(os.environ.get('STORAGE_S3_CONNECT_TIMEOUT', 2))
+    STORAGE_S3_READ_TIMEOUT = float(os.environ.get('STORAGE_S3_READ_TIMEOUT', 5))
+    STORAGE_S3_TCP_KEEPALIVE = os.environ.get('STORAGE_S3_TCP_KEEPALIVE', "true") == "true"
+    STORAGE_S3_RETRY_MODE = os.environ.get('STORAGE_S3_RETRY_MODE', 'standard')
+    STORAGE_S3_MAX_ATTEMPTS = int(os.environ.get('STORAGE_S3_MAX_ATTEMPTS', 3))
+    STORAGE_SQLITE_PATH = os.environ.get('STORAGE_SQLITE_PATH', 'developers.sqlite3')
+    # Users and keys are written as 'json' or 'msgpack' (which needs the
+    # msgpack package). Either can always be read.
+    STORAGE_CODEC = os.environ.get('STORAGE_CODEC', 'json')
+    # Number of threads used to make storage requests concurrently
+    STORAGE_MAX_WORKERS = int(os.environ.get('STORAGE_MAX_WORKERS', 16))
+
+    # Writes are recorded in a change feed that every process polls, so
+    # cached entries changed by another process are dropped within seconds.
+    # `flask prune-change-feed` deletes changes older than the retention.
+    CHANGE_FEED_ENABLE = os.environ.get('CHANGE_FEED_ENABLE', "false") == "true"
+    CHANGE_FEED_INTERVAL = float(os.environ.get('CHANGE_FEED_INTERVAL', 5))
+    CHANGE_FEED_LOOKBACK = float(os.environ.get('CHANGE_FEED_LOOKBACK', 60))
+    CHANGE_FEED_RETENTION = float(os.environ.get('CHANGE_FEED_RETENTION', 86400))
+
+    # Verify requests are counted per key and origin in memory and flushed
+    # to storage in batches this often. Origins past the most used
+    # USAGE_MAX_ORIGINS per key and day are counted together.
+    USAGE_METERING_ENABLE = os.environ.get('USAGE_METERING_ENABLE', "true") == "true"
+    USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', 60))
+    USAGE_RETAIN_DAYS = int(os.environ.get('USAGE_RETAIN_DAYS', 90))
+    USAGE_MAX_ORIGINS = int(os.environ.get('USAGE_MAX_ORIGINS', 100))
+
+    # Cache-Control headers sent with /verify responses so CDNs and edge
+    # checkers can cache verdicts
+    VERIFY_CACHE_CONTROL_SUCCESS = os.environ.get('VERIFY_CACHE_CONTROL_SUCCESS', 'public, max-age=300, stale-while-revalidate=3600')
+    VERIFY_CACHE_CONTROL_DISABLED = os.environ.get('VERIFY_CACHE_CONTROL_DISABLED', 'public, max-age=60, stale-while-revalidate=300')
+    VERIFY_CACHE_CONTROL_UNKNOWN = os.environ.get('VERIFY_CACHE_CONTROL_UNKNOWN', 'public, max-age=60')
+    VERIFY_CACHE_CONTROL_RATE_LIMITED = os.environ.get('VERIFY_CACHE_CONTROL_RATE_LIMITED', 'public, max-age=10')
+
+    # Keys with a rate limit set get that many verified requests per window,
+    # shared between workers that sync their counts this often
+    RATE_LIMIT_ENABLE = os.environ.get('RATE_LIMIT_ENABLE', "true") == "true"
+    RATE_LIMIT_WINDOW = int(os.environ.get('RATE_LIMIT_WINDOW', 60))
+    RATE_LIMIT_SYNC_INTERVAL = float(os.environ.get('RATE_LIMIT_SYNC_INTERVAL', 5))
+
+    # Key snapshots for edge consumers. /snapshot is only served when an
+    # access token is set, and requests must send it as a bearer token.
+    SNAPSHOT_ACCESS_TOKEN = os.environ.get('SNAPSHOT_ACCESS_TOKEN')
+    SNAPSHOT_RETAIN = int(os.environ.get('SNAPSHOT_RETAIN', 48))
+    SNAPSHOT_CACHE_CONTROL = os.environ.get('SNAPSHOT_CACHE_CONTROL', 'public, max-age=60')
+
+    # Prometheus metrics for this process are served at /metrics when an
+    # access token is set, and scrapes must send it as a bearer token.
+    METRICS_ACCESS_TOKEN = os.environ.get('METRICS_ACCESS_TOKEN')
+
+    # Number of keys saved at once by bulk admin actions
+    BULK_MAX_WORKERS = int(os.environ.get('BULK_MAX_WORKERS', 16))
+
+    # Request bodies larger than this many bytes, such as oversized
+    # /verify/batch requests, are rejected with a 413 before they are read
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 1024 * 1024))
+
+    # Largest number of api_key/origin pairs accepted by /verify/batch, and
+    # how many of them are resolved at a time while streaming the response
+    VERIFY_BATCH_MAX_ITEMS = int(os.environ.get('VERIFY_BATCH_MAX_ITEMS', 1000))
+    VERIFY_BATCH_CHUNK_SIZE = int(os.environ.get('VERIFY_BATCH_CHUNK_SIZE', 100))
+
+    # Users and keys are cached in-process for this many seconds, so changes
+    # made by other processes are seen after at most this long
+    CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+    # Entries older than this are still served, but reloaded in the background
+    # so hot users and keys are replaced before they expire. Set it to at
+    # least CACHE_TTL to turn background refreshes off.
+    CACHE_SOFT_TTL = int(os.environ.get('CACHE_SOFT_TTL', 240))
+    # Upper bound on the memory used by cached entries, in bytes
+    CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 100e6)) # ~100 MB
+    CACHE_SEGMENTS = int(os.environ.get('CACHE_SEGMENTS', 16))
+    # Lookups for users and keys that don't exist are cached for this many
+    # seconds, separately from real entries
+    NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 60))
+    NEGATIVE_CACHE_SIZE = int(os.environ.get('NEGATIVE_CACHE_SIZE', 100000))
+    # Fill the cache with every key from the object written by
+    # `flask build-key-state` at startup, unless it is older than this many
+    # seconds
+    CACHE_PRELOAD_ENABLE = os.environ.get('CACHE_PRELOAD_ENABLE', "false") == "true"
+    CACHE_PRELOAD_MAX_AGE = int(os.environ.get('CACHE_PRELOAD_MAX_AGE', 86400))
+    # The most used cached users and keys are saved this often, to a file at
+    # HOT_KEYS_PATH if it is set or to storage otherwise, and loaded into the
+    # cache in the background when a process starts
+    HOT_KEYS_ENABLE = os.environ.get('HOT_KEYS_ENABLE', "false") == "true"
+    HOT_KEYS_INTERVAL = float(os.environ.get('HOT_KEYS_INTERVAL', 60))
+    HOT_KEYS_COUNT = int(os.environ.get('HOT_KEYS_COUNT', 1000))
+    HOT_KEYS_PATH = os.environ.get('HOT_KEYS_PATH')
 
     SENTRY_ENABLE = os.environ.get('SENTRY_ENABLE') == 'true'
 
+    # Defer building the S3 client and Sentry until they are first used, so
+    # cold starts (e.g. on Lambda) only pay for what the first request needs
+    LAZY_STARTUP = os.environ.get('LAZY_STARTUP', "false") == "true"
+
     OAUTH_CREDENTIALS = {
         'facebook': {
             'id': os.environ.get('FACEBOOK_CLIENT_ID'),
@@ -0,0 +1,76 @@
+import json
+import os
+from .background import run_periodically
+from .storage import ApiKey, User
+
+# The cache's most used keys are saved every few seconds, to a local file if
+# a path is configured (e.g. under /tmp, which survives between invocations
+# of a warm Lambda container) or otherwise to storage, shared by every
+# process. A new process reads the last saved set and loads those users and
+# keys into its cache in the background, so it doesn't have to rebuild its
+# working set one miss at a time.
+COLLECTION = 'hot-keys'
+NAME = 'latest'
+
+
+class HotKeys(object):
+    def __init__(self, app, interval, count, path=None):
+        self.app = app
+        self.interval = interval
+        self.count = count
+        self.path = path
+        self._thread = None
+
+    @property
+    def backend(self):
+        return self.app.extensions['storage']
+
+    def save(self):
+        cache_keys = self.app.extensions['key_cache'].top(self.count)
+        if not cache_keys:
+            return
+
+        body = json.dumps(cache_keys)
+        if self.path:
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(body)
+            os.replace(tmp, self.path)
+        else:
+            self.backend.put_object(COLLECTION, NAME, body)
+
+    def saved(self):
+        if self.path:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path) as f:
+                return json.load(f)
+
+        body = self.backend.get_object(COLLECTION, NAME)
+        return json.loads(body.decode('utf8')) if body else []
+
+    # Load the saved users and keys that aren't cached yet, concurrently.
+    # Returns how many were asked for.
+    def restore(self):
+        names = {User.cache_prefix: [], ApiKey.cache_prefix: []}
+        for cache_key in self.saved():
+            prefix, name = cache_key.split('.', 1)
+            if prefix in names:
+                names[prefix].append(name)
+
+        with self.app.app_context():
+            User.get_many(names[User.cache_prefix])
+            ApiKey.get_many(names[ApiKey.cache_prefix])
+        return sum(len(n) for n in names.values())
+
+    def _restore_logged(self):
+        try:
+            restored = self.restore()
+            self.app.logger.info("Restored %s hot users and keys", restored)
+        except Exception:
+            self.app.logger.exception("Couldn't restore hot keys")
+
+    def start(self):
+        self._thread = run_periodically(
+            self.app, 'hot-keys', self.interval, self.save, "Couldn't save hot keys",
+            first=self._restore_logged, at_exit=True)
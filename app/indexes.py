@@ -0,0 +1,133 @@
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+
+# Secondary indexes let admins find users and keys by something other than
+# their ID. Each index maps terms (an email address, a key name, a state like
+# 'admin_locked') to the IDs of the objects that have them, and is split over
+# a fixed number of shard objects in the `indexes` collection, each a JSON
+# object of term to sorted list of IDs.
+#
+# Indexes with few, very large terms are sharded by member so no one shard
+# holds every ID. Looking a term up in those means reading every shard.
+#
+# Shards are shared by every process, so each update is a conditional write
+# that is retried from a fresh read if another writer got there first. With a
+# backend that can't write conditionally, updates from different processes
+# can still overwrite each other, and `flask rebuild-indexes` should run on a
+# schedule to repair them.
+
+
+class Index(object):
+    def __init__(self, name, shards, shard_by_member=False):
+        self.name = name
+        self.shards = shards
+        self.shard_by_member = shard_by_member
+
+    def shard_names(self):
+        return ['%s.%03d' % (self.name, n) for n in range(self.shards)]
+
+    def shard_name(self, term, member):
+        value = member if self.shard_by_member else term
+        n = int(hashlib.sha1(value.encode('utf8')).hexdigest(), 16) % self.shards
+        return '%s.%03d' % (self.name, n)
+
+
+INDEXES = dict((index.name, index) for index in [
+    Index('user_email', shards=64),
+    Index('user_state', shards=8, shard_by_member=True),
+    Index('key_name', shards=64),
+    Index('key_state', shards=16, shard_by_member=True),
+])
+
+# Serializes read-modify-write updates to a shard within this process, so
+# conditional writes only conflict with other processes
+_shard_locks = collections.defaultdict(threading.Lock)
+
+SHARD_WRITE_ATTEMPTS = 10
+
+
+def _read_shard(backend, name):
+    body = backend.get_object('indexes', name)
+    return json.loads(body.decode('utf8')) if body else {}
+
+
+def _update_shard(backend, name, ops):
+    with _shard_locks[name]:
+        for attempt in range(SHARD_WRITE_ATTEMPTS):
+            body, version = backend.get_object_version('indexes', name)
+            doc = json.loads(body.decode('utf8')) if body else {}
+            for term, member, add in ops:
+                members = set(doc.get(term, ()))
+                if add:
+                    members.add(member)
+                else:
+                    members.discard(member)
+
+                if members:
+                    doc[term] = sorted(members)
+                else:
+                    doc.pop(term, None)
+
+            if backend.put_object_if('indexes', name, json.dumps(doc, sort_keys=True), version):
+                return
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+    raise RuntimeError("Couldn't update index shard %s after %d attempts" % (name, SHARD_WRITE_ATTEMPTS))
+
+
+# Work out the index entries to add and remove for an object whose indexed
+# terms went from `old_terms` to `new_terms`. Both map index names to sets of
+# terms.
+def changes_for(member, old_terms, new_terms):
+    changes = []
+    for index_name in INDEXES:
+        old = old_terms.get(index_name, set())
+        new = new_terms.get(index_name, set())
+        changes.extend((index_name, term, member, False) for term in old - new)
+        changes.extend((index_name, term, member, True) for term in new - old)
+    return changes
+
+
+# Returns the (function, args) calls that apply (index name, term, member,
+# add) changes, one per affected shard
+def updates(backend, changes):
+    by_shard = collections.defaultdict(list)
+    for index_name, term, member, add in changes:
+        shard = INDEXES[index_name].shard_name(term, member)
+        by_shard[shard].append((term, member, add))
+
+    return [(_update_shard, (backend, name, ops)) for name, ops in by_shard.items()]
+
+
+# Find the members with `term` in an index, reading shards with `map_fn`
+# (which may read them concurrently)
+def lookup(backend, index_name, term, map_fn=map):
+    index = INDEXES[index_name]
+    if index.shard_by_member:
+        names = index.shard_names()
+    else:
+        names = [index.shard_name(term, None)]
+
+    members = set()
+    for doc in map_fn(lambda name: _read_shard(backend, name), names):
+        members.update(doc.get(term, ()))
+    return sorted(members)
+
+
+# Replace every shard of every index with ones built from `objects`
+def rebuild(backend, run, objects):
+    docs = dict((name, {}) for index in INDEXES.values() for name in index.shard_names())
+    for member, terms in objects:
+        for index_name, index_terms in terms.items():
+            for term in index_terms:
+                shard = INDEXES[index_name].shard_name(term, member)
+                docs[shard].setdefault(term, []).append(member)
+
+    run([
+        (backend.put_object, ('indexes', name, json.dumps(dict((t, sorted(m)) for t, m in doc.items()), sort_keys=True)))
+        for name, doc in docs.items()
+    ])
@@ -0,0 +1,71 @@
+import json
+import time
+import zlib
+from .storage import ApiKey
+
+# The key state object holds every API key in one zlib-compressed JSON
+# document, stored column by column so repeated values compress well:
+#
+#   {"built_at": <ms>, "count": <n>, "columns": {"api_key": [...], ...}}
+#
+# A new process can load it with one read and fill its cache with every key
+# instead of reading keys one at a time as traffic arrives. Keys created
+# after it was built are still loaded from storage on their first lookup.
+COLLECTION = 'key-state'
+NAME = 'all'
+
+COLUMNS = (
+    'api_key',
+    'person_id',
+    'enabled',
+    'name',
+    'allowed_origins',
+    'rate_limit',
+    'created_at',
+    'admin_locked',
+    'admin_lock_user',
+    'admin_lock_reason',
+    'admin_lock_at',
+)
+
+
+def encode(keys, built_at):
+    rows = [k.as_dict() for k in keys]
+    doc = {
+        'built_at': built_at,
+        'count': len(rows),
+        'columns': dict((column, [row[column] for row in rows]) for column in COLUMNS),
+    }
+    return zlib.compress(json.dumps(doc, separators=(',', ':')).encode('utf8'), 9)
+
+
+# Returns (built_at, list of key dicts)
+def decode(body):
+    doc = json.loads(zlib.decompress(body).decode('utf8'))
+    columns = [doc['columns'][column] for column in COLUMNS]
+    return doc['built_at'], [dict(zip(COLUMNS, values)) for values in zip(*columns)]
+
+
+# Write a new key state object from `keys`, returning how many it holds
+def build(backend, keys):
+    keys = list(keys)
+    backend.put_object(COLLECTION, NAME, encode(keys, int(time.time() * 1000)), 'application/octet-stream')
+    return len(keys)
+
+
+# Fill `cache` from the key state object, unless it is missing or more than
+# `max_age` seconds old. Other processes may have changed keys since it was
+# built, so the entries are marked to be refreshed in the background on their
+# first lookup. Returns how many keys were loaded.
+def preload(backend, cache, max_age):
+    body = backend.get_object(COLLECTION, NAME)
+    if body is None:
+        return 0
+
+    built_at, rows = decode(body)
+    if time.time() - built_at / 1000.0 > max_age:
+        return 0
+
+    for row in rows:
+        cache.set('%s.%s' % (ApiKey.cache_prefix, row['api_key']), ApiKey.from_dict(row), stale=True)
+    return len(rows)
@@ -0,0 +1,232 @@
+import bisect
+import threading
+import time
+from flask import g, request
+
+# A small, dependency-free metrics registry rendered in the Prometheus text
+# exposition format. Every metric keeps its values in memory behind its own
+# lock, so recording is a dict update and rendering happens only on scrape.
+# Each process has its own registry.
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield self.name + '_bucket', labels + [('le', le)], cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+# Reports values owned by something else, like the key cache's statistics,
+# by calling `fn` at scrape time. `fn` returns a list of (labels, value).
+class Collected(object):
+    def __init__(self, name, help, type, fn):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        for labels, value in self.fn():
+            yield self.name, sorted(labels.items()), value
+
+
+class Registry(object):
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._metrics = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def __getitem__(self, name):
+        return self._metrics['%s_%s' % (self.namespace, name)]
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter('%s_%s' % (self.namespace, name), help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram('%s_%s' % (self.namespace, name), help, labelnames, buckets))
+
+    def collected(self, name, help, type, fn):
+        return self._add(Collected('%s_%s' % (self.namespace, name), help, type, fn))
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for sample_name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample_name, _format_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+# Times every call to the wrapped storage backend, labelled by operation and
+# the top level of the collection so per-day collections don't each get
+# their own series
+class InstrumentedBackend(object):
+    def __init__(self, backend, registry):
+        self.backend = backend
+        self.duration = registry.histogram(
+            'storage_operation_duration_seconds',
+            'Time spent on storage operations.',
+            ['operation', 'collection'],
+        )
+        self.errors = registry.counter(
+            'storage_errors_total',
+            'Storage operations that raised an error.',
+            ['operation', 'collection'],
+        )
+
+    def _timed(self, operation, collection, fn, *args):
+        collection = collection.split('/', 1)[0]
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception:
+            self.errors.inc(operation=operation, collection=collection)
+            raise
+        finally:
+            self.duration.observe(time.perf_counter() - start, operation=operation, collection=collection)
+
+    def get_object(self, collection, name):
+        return self._timed('get', collection, self.backend.get_object, collection, name)
+
+    def put_object(self, collection, name, body, content_type='application/json'):
+        return self._timed('put', collection, self.backend.put_object, collection, name, body, content_type)
+
+    def delete_object(self, collection, name):
+        return self._timed('delete', collection, self.backend.delete_object, collection, name)
+
+    def delete_objects(self, collection, names):
+        return self._timed('delete', collection, self.backend.delete_objects, collection, names)
+
+    def get_object_version(self, collection, name):
+        return self._timed('get', collection, self.backend.get_object_version, collection, name)
+
+    def put_object_if(self, collection, name, body, version, content_type='application/json'):
+        return self._timed('put', collection, self.backend.put_object_if, collection, name, body, version, content_type)
+
+    def list_objects(self, collection, start_after=None):
+        return self._timed('list', collection, lambda: list(self.backend.list_objects(collection, start_after)))
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+def init_app(app):
+    registry = app.extensions['metrics'] = Registry('developers')
+
+    request_duration = registry.histogram(
+        'request_duration_seconds',
+        'Time spent handling requests, by endpoint.',
+        ['endpoint', 'status'],
+    )
+    registry.counter(
+        'verify_verdicts_total',
+        'Verdicts returned by /verify and /verify/batch.',
+        ['verdict'],
+    )
+
+    def cache_stat(stat):
+        return lambda: [({}, app.extensions['key_cache'].stats()[stat])]
+
+    for stat, type, help in [
+        ('hits', 'counter', 'Key cache lookups that found an entry.'),
+        ('misses', 'counter', 'Key cache lookups that found nothing.'),
+        ('negative_hits', 'counter', 'Key cache lookups that found a cached miss.'),
+        ('evictions', 'counter', 'Key cache entries evicted to stay within the byte budget.'),
+        ('expirations', 'counter', 'Key cache entries dropped after their TTL.'),
+        ('refreshes', 'counter', 'Key cache entries reloaded in the background before expiring.'),
+        ('entries', 'gauge', 'Entries in the key cache.'),
+        ('negative_entries', 'gauge', 'Cached misses in the key cache.'),
+        ('bytes', 'gauge', 'Estimated bytes used by key cache entries.'),
+        ('max_bytes', 'gauge', 'Byte budget of the key cache.'),
+    ]:
+        name = 'cache_%s' % stat
+        if type == 'counter':
+            name += '_total'
+        registry.collected(name, help, type, cache_stat(stat))
+
+    registry.collected(
+        'cache_coalesced_loads_total',
+        'Cache misses that waited for a load of the same object already in progress.',
+        'counter',
+        lambda: [({}, app.extensions['key_loads'].coalesced)],
+    )
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started_at = time.perf_counter()
+
+    @app.after_request
+    def observe_request_duration(response):
+        started_at = g.get('request_started_at')
+        if started_at is not None:
+            request_duration.observe(
+                time.perf_counter() - started_at,
+                endpoint=request.endpoint or 'none',
+                status='%dxx' % (response.status_code // 100),
+            )
+        return response
+
+    return registry
@@ -0,0 +1,98 @@
+import collections
+import json
+import threading
+import time
+import uuid
+from .background import run_periodically
+
+
+# Enforces per-key request budgets over a sliding window of `window` seconds,
+# approximated from counts in the current and previous fixed windows.
+#
+# Requests are counted in memory, so checking a budget never does I/O. Every
+# `sync_interval` seconds each worker publishes its counts for the current
+# window to the `ratelimit/<window>` collection and reads everyone else's, so
+# a key's budget is shared by every worker give or take one sync interval.
+# Workers that haven't seen a rate limited key for two windows don't sync.
+class RateLimiter(object):
+    def __init__(self, app, window, sync_interval):
+        self.app = app
+        self.window = window
+        self.sync_interval = sync_interval
+        self.worker_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._current = None
+        self._local = collections.Counter()
+        self._remote = {}
+        self._previous = collections.Counter()
+        self._last_limited = None
+        self._published = set()
+        self._thread = None
+
+    @property
+    def backend(self):
+        return self.app.extensions['storage']
+
+    def _roll(self, now):
+        current = int(now // self.window)
+        if current == self._current:
+            return
+
+        if current == (self._current or 0) + 1:
+            self._previous = self._local + collections.Counter(self._remote)
+        else:
+            self._previous = collections.Counter()
+        self._current = current
+        self._local = collections.Counter()
+        self._remote = {}
+
+    # Count a request against `api_key`, returning false if it is over
+    # `limit` requests per window
+    def allow(self, api_key, limit):
+        now = time.time()
+
+        with self._lock:
+            self._last_limited = now
+            self._roll(now)
+            elapsed = (now % self.window) / self.window
+            used = self._local[api_key] + self._remote.get(api_key, 0) + self._previous[api_key] * (1 - elapsed)
+            if used >= limit:
+                return False
+
+            self._local[api_key] += 1
+            return True
+
+    def sync(self):
+        now = time.time()
+        with self._lock:
+            active = self._last_limited is not None and now - self._last_limited <= 2 * self.window
+            if active:
+                self._roll(now)
+            current, counts = int(now // self.window), dict(self._local)
+
+        if active:
+            collection = 'ratelimit/%d' % current
+            if counts:
+                self.backend.put_object(collection, self.worker_id, json.dumps(counts))
+                self._published.add(current)
+
+            names = [name for name in self.backend.list_objects(collection) if name != self.worker_id]
+            remote = collections.Counter()
+            executor = self.app.extensions['storage_executor']
+            for body in executor.map(lambda name: self.backend.get_object(collection, name), names):
+                if body:
+                    remote.update(json.loads(body.decode('utf8')))
+
+            with self._lock:
+                if self._current == current:
+                    self._remote = dict(remote)
+
+        # Windows before the previous one are never read again
+        for window in sorted(self._published):
+            if window <= current - 2:
+                self.backend.delete_object('ratelimit/%d' % window, self.worker_id)
+                self._published.discard(window)
+
+    def start(self):
+        self._thread = run_periodically(
+            self.app, 'rate-limiter', self.sync_interval, self.sync, "Couldn't sync rate limit counts")
@@ -0,0 +1,39 @@
+import threading
+from flask import g, got_request_exception, request
+
+
+# Reports exceptions raised while handling requests to Sentry, but only
+# imports raven and builds its client when the first one happens, so cold
+# starts don't pay for it. Unlike raven's full Flask integration this doesn't
+# forward log records or wrap the WSGI app.
+class LazySentry(object):
+    def __init__(self, app):
+        self.app = app
+        self._sentry = None
+        self._lock = threading.Lock()
+        got_request_exception.connect(self.handle_exception, sender=app, weak=False)
+
+    @property
+    def sentry(self):
+        if self._sentry is None:
+            with self._lock:
+                if self._sentry is None:
+                    from raven.contrib.flask import Sentry, make_client
+                    sentry = Sentry()
+                    sentry.client = make_client(sentry.client_cls, self.app, sentry.dsn)
+                    self._sentry = sentry
+        return self._sentry
+
+    @property
+    def client(self):
+        return self.sentry.client
+
+    def handle_exception(self, sender, exception=None, **kwargs):
+        sentry = self.sentry
+        try:
+            sentry.client.http_context(sentry.get_http_info(request))
+            sentry.client.user_context(sentry.get_user_info(request))
+            sentry.handle_exception(exception=exception)
+            g.sentry_event_id = sentry.last_event_id
+        finally:
+            sentry.client.context.clear()
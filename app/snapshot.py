@@ -0,0 +1,149 @@
+import hashlib
+import struct
+import time
+from flask import current_app
+from .storage import ApiKey, storage_backend
+
+# A snapshot is a compact binary listing of every API key's verify state, so
+# edge consumers can load all verdicts at once instead of calling /verify for
+# each key. Keys are identified by the SHA-1 of the API key, never the key
+# itself. All integers are big-endian.
+#
+#   header: magic 'NZKS', u8 format, u8 kind, u64 version, u64 base version,
+#           u32 entry count
+#   entry:  20 byte key hash, u8 flags, u16 origin count, and for each origin
+#           a u16 length followed by that many bytes of UTF-8
+#
+# A full snapshot (kind 0) lists every key. A delta (kind 1) lists only the
+# keys that changed between the base version and version, with deleted keys
+# flagged as such.
+MAGIC = b'NZKS'
+FORMAT = 1
+
+FULL = 0
+DELTA = 1
+
+ENABLED = 0x01
+ADMIN_LOCKED = 0x02
+DELETED = 0x04
+
+_HEADER = struct.Struct('!4sBBQQI')
+_ENTRY = struct.Struct('!20sBH')
+_LENGTH = struct.Struct('!H')
+
+
+def key_hash(api_key):
+    return hashlib.sha1(api_key.encode('utf8')).digest()
+
+
+def entry_for(k):
+    flags = 0
+    if k.enabled:
+        flags |= ENABLED
+    if k.admin_locked:
+        flags |= ADMIN_LOCKED
+    return flags, tuple(k.allowed_origins or ())
+
+
+def encode(kind, version, base_version, entries):
+    parts = [_HEADER.pack(MAGIC, FORMAT, kind, version, base_version, len(entries))]
+    for h, (flags, origins) in sorted(entries.items()):
+        parts.append(_ENTRY.pack(h, flags, len(origins)))
+        for origin in origins:
+            origin = origin.encode('utf8')
+            parts.append(_LENGTH.pack(len(origin)))
+            parts.append(origin)
+    return b''.join(parts)
+
+
+# Returns (kind, version, base version, entries) where entries maps each key
+# hash to a (flags, origins) tuple
+def decode(body):
+    magic, fmt, kind, version, base_version, count = _HEADER.unpack_from(body, 0)
+    if magic != MAGIC or fmt != FORMAT:
+        raise ValueError("Not a version %s key snapshot" % FORMAT)
+
+    offset = _HEADER.size
+    entries = {}
+    for _ in range(count):
+        h, flags, n = _ENTRY.unpack_from(body, offset)
+        offset += _ENTRY.size
+        origins = []
+        for _ in range(n):
+            length, = _LENGTH.unpack_from(body, offset)
+            offset += _LENGTH.size
+            origins.append(body[offset:offset + length].decode('utf8'))
+            offset += length
+        entries[h] = (flags, tuple(origins))
+    return kind, version, base_version, entries
+
+
+def diff(old_entries, new_entries):
+    changes = {}
+    for h, entry in new_entries.items():
+        if old_entries.get(h) != entry:
+            changes[h] = entry
+    for h in old_entries:
+        if h not in new_entries:
+            changes[h] = (DELETED, ())
+    return changes
+
+
+def latest_version():
+    body = storage_backend().get_object('snapshots', 'LATEST')
+    return int(body) if body else None
+
+
+def load(version):
+    body = storage_backend().get_object('snapshots', '%013d' % version)
+    return decode(body) if body else None
+
+
+# Read every key from storage and write a new full snapshot, plus a delta to
+# it from each retained older snapshot, then point LATEST at it and prune
+# snapshots beyond the retention limit. Returns the version.
+def build():
+    backend = storage_backend()
+    version = int(time.time() * 1000)
+    name = '%013d' % version
+
+    entries = dict((key_hash(k.api_key), entry_for(k)) for k in ApiKey.scan())
+    backend.put_object('snapshots', name, encode(FULL, version, 0, entries), 'application/octet-stream')
+
+    # Deltas are keyed by the version they start from and overwritten by
+    # each build, so /snapshot serves them with a single read
+    versions = [v for v in backend.list_objects('snapshots') if v.isdigit()]
+    retained = versions[-current_app.config.get('SNAPSHOT_RETAIN'):]
+    for since in retained:
+        if since == name:
+            changes = {}
+        else:
+            base = load(int(since))
+            if base is None:
+                continue
+            changes = diff(base[3], entries)
+        backend.put_object('snapshot-deltas', since, encode(DELTA, version, int(since), changes), 'application/octet-stream')
+
+    backend.put_object('snapshots', 'LATEST', str(version), 'text/plain')
+    current_app.logger.info("Built key snapshot %s with %s keys", version, len(entries))
+
+    for since in versions[:-len(retained)]:
+        backend.delete_object('snapshot-deltas', since)
+        backend.delete_object('snapshots', since)
+
+    return version
+
+
+# Returns the encoded changes from `since` to the latest snapshot, or the
+# full latest snapshot if `since` is missing or has been pruned
+def export(since=None):
+    backend = storage_backend()
+    if since:
+        body = backend.get_object('snapshot-deltas', '%013d' % since)
+        if body is not None:
+            return body
+
+    version = latest_version()
+    if version is None:
+        return None
+    return backend.get_object('snapshots', '%013d' % version)
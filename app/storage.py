@@ -1,14 +1,15 @@
 import base64
-import boto3
+import contextlib
 import datetime
 import fnmatch
 import hashlib
-import posixpath
+import re
+import threading
 import uuid
-from flask import current_app, json
-from flask_login import UserMixin
+from concurrent.futures import Future, wait
+from flask import current_app, g
 from six.moves.urllib.parse import urlparse
-from . import login_manager
+from . import codec, indexes, login_manager
 
 
 def hash_base64(text):
@@ -30,12 +31,303 @@ def validate_allowed_origins(origins):
     return True
 
 
+# Matches origins against a list of fnmatch-style allowed origin patterns.
+# Literal patterns are checked with a set lookup, wildcard patterns with a
+# single combined regex. The regex is only compiled the first time an origin
+# needs it, since keys are often loaded without their origins being checked.
+# Verdicts aren't remembered: origins come from callers, and anything kept
+# per origin would grow cached keys past the size the cache measured.
+class OriginMatcher(object):
+    __slots__ = ('exact', 'wildcards', 'regex')
+
+    def __init__(self, patterns):
+        self.exact = set()
+        self.wildcards = []
+        for pattern in patterns:
+            if any(c in pattern for c in '*?['):
+                self.wildcards.append(pattern)
+            else:
+                self.exact.add(pattern)
+        self.regex = None
+
+    def matches(self, origin):
+        if origin in self.exact:
+            return True
+
+        if not self.wildcards:
+            return False
+
+        if self.regex is None:
+            self.regex = re.compile('|'.join(fnmatch.translate(p) for p in self.wildcards))
+        return self.regex.match(origin) is not None
+
+
+def storage_backend():
+    return current_app.extensions['storage']
+
+
+def storage_executor():
+    return current_app.extensions['storage_executor']
+
+
+# Start each (function, args) pair on the storage thread pool, returning
+# their futures. A single call, or calls made from a storage thread, run in
+# the calling thread instead, since waiting on the pool from one of its own
+# threads can deadlock.
+def start_calls(calls):
+    if len(calls) != 1 and not threading.current_thread().name.startswith('storage'):
+        return [storage_executor().submit(fn, *args) for fn, args in calls]
+
+    futures = []
+    for fn, args in calls:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        futures.append(future)
+    return futures
+
+
+# Call each (function, args) pair, on the storage thread pool if there is
+# more than one, and raise the first error once they have all finished.
+# Returns their results in order.
+def run_concurrently(calls):
+    futures = start_calls(calls)
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+# Fetch an object from storage and cache it, or cache that it doesn't exist.
+# Concurrent loads of the same object share one read.
+def load_object(clz, name):
+    cache_key = '%s.%s' % (clz.cache_prefix, name)
+    return current_app.extensions['key_loads'].do(cache_key, _fetch_object, clz, name, cache_key)
+
+
+def _fetch_object(clz, name, cache_key):
+    cache = current_app.extensions['key_cache']
+    body = storage_backend().get_object(clz.collection, name)
+
+    if body is None:
+        cache.set_negative(cache_key)
+        return None
+
+    obj = clz.from_dict(codec.decode(body))
+    cache.set(cache_key, obj)
+    current_app.logger.debug("Stored %s %s in cache", clz.cache_prefix, name)
+    return obj
+
+
+# Reload a cached user or key that is due to expire, on a background thread
+def refresh_object(app, cache_key):
+    prefix, name = cache_key.split('.', 1)
+    clz = {User.cache_prefix: User, ApiKey.cache_prefix: ApiKey}[prefix]
+
+    with app.app_context():
+        try:
+            load_object(clz, name)
+        except Exception:
+            app.logger.exception("Couldn't refresh %s", cache_key)
+
+
+# Look up several objects at once, fetching the ones that aren't cached from
+# storage concurrently
+def get_many_objects(clz, names):
+    cache = current_app.extensions['key_cache']
+    results = {}
+    misses = []
+
+    for name in set(names):
+        found, cached = cache.get('%s.%s' % (clz.cache_prefix, name))
+        if found:
+            results[name] = cached
+        else:
+            misses.append(name)
+
+    if misses:
+        app = current_app._get_current_object()
+
+        def load(name):
+            with app.app_context():
+                return load_object(clz, name)
+
+        results.update(zip(misses, storage_executor().map(load, misses)))
+
+    return results
+
+
+# Yield every stored object in a collection, reading them from storage
+# concurrently without going through the cache
+def scan_objects(clz):
+    backend = storage_backend()
+
+    def load(name):
+        body = backend.get_object(clz.collection, name)
+        return clz.from_dict(codec.decode(body)) if body is not None else None
+
+    for obj in storage_executor().map(load, backend.list_objects(clz.collection)):
+        if obj:
+            yield obj
+
+
+# Find the IDs of objects in a secondary index with the given term
+def search_index(index_name, term):
+    return indexes.lookup(storage_backend(), index_name, term, storage_executor().map)
+
+
+# Collects the objects saved and deleted while it is active so each is
+# serialized once, then writes them all concurrently and invalidates their
+# cache entries when it commits
+class UnitOfWork(object):
+    def __init__(self):
+        self._saves = {}
+        self._deletes = {}
+
+    def save(self, obj):
+        collection, name, cache_key = obj.storage_location()
+        self._deletes.pop((collection, name), None)
+        self._saves[(collection, name)] = (obj, cache_key)
+
+    def delete(self, obj):
+        collection, name, cache_key = obj.storage_location()
+        self._saves.pop((collection, name), None)
+        self._deletes[(collection, name)] = (obj, cache_key)
+
+    def commit(self):
+        backend = storage_backend()
+        storage_codec = current_app.config.get('STORAGE_CODEC')
+        calls = []
+        cache_keys = []
+        index_changes = []
+
+        for (collection, name), (obj, cache_key) in self._saves.items():
+            body, content_type = codec.encode(obj.as_dict(), storage_codec)
+            calls.append((backend.put_object, (collection, name, body, content_type)))
+            cache_keys.append(cache_key)
+            index_changes.extend(indexes.changes_for(name, obj.indexed_terms or {}, obj.index_terms()))
+
+        for (collection, name), (obj, cache_key) in self._deletes.items():
+            calls.append((backend.delete_object, (collection, name)))
+            cache_keys.append(cache_key)
+            index_changes.extend(indexes.changes_for(name, obj.indexed_terms or obj.index_terms(), {}))
+
+        if not calls:
+            return
+
+        # Index updates and change feed entries don't depend on the writes,
+        # so they run alongside them. If they fail the writes still stand:
+        # the failure is logged, and `flask rebuild-indexes` repairs indexes.
+        side_calls = [('update index shard %s' % args[1], (fn, args)) for fn, args in indexes.updates(backend, index_changes)]
+        feed = current_app.extensions.get('change_feed')
+        if feed:
+            side_calls.extend(('record %s in the change feed' % key, (feed.append, (key,))) for key in cache_keys)
+
+        futures = start_calls(calls + [call for _, call in side_calls])
+        wait(futures)
+
+        # Dropped even if a write failed, since the cached objects may have
+        # been changed in place
+        cache = current_app.extensions['key_cache']
+        for cache_key in cache_keys:
+            cache.pop(cache_key)
+
+        for (description, _), future in zip(side_calls, futures[len(calls):]):
+            if future.exception() is not None:
+                current_app.logger.error("Couldn't %s", description, exc_info=future.exception())
+
+        for future in futures[:len(calls)]:
+            future.result()
+
+        for obj, _ in self._saves.values():
+            obj.indexed_terms = obj.index_terms()
+
+
+# Group the saves and deletes made inside the block into one unit of work
+# that commits when the block exits without an error. Nested blocks join the
+# outermost unit of work.
+@contextlib.contextmanager
+def unit_of_work():
+    uow = g.get('unit_of_work')
+    if uow is not None:
+        yield uow
+        return
+
+    g.unit_of_work = uow = UnitOfWork()
+    try:
+        yield uow
+    finally:
+        g.pop('unit_of_work', None)
+    uow.commit()
+
+
 @login_manager.user_loader
 def load_user(id):
     return User.get_by_user_id(id)
 
 
-class User(UserMixin):
+# Timestamps are stored as milliseconds since the epoch. Loaded objects keep
+# them that way until they are first read, since most lookups never need them.
+def _millis(value):
+    if value is None or isinstance(value, int):
+        return value
+    return int(value.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def _lazy_datetime(slot):
+    def get(self):
+        value = getattr(self, slot)
+        if isinstance(value, int):
+            value = datetime.datetime.utcfromtimestamp(value / 1000)
+            setattr(self, slot, value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+
+    return property(get, set)
+
+
+# Users and keys use __slots__ to keep cached entries small. User implements
+# what Flask-Login expects itself, since UserMixin would give every instance
+# a __dict__.
+class User(object):
+    collection = 'users'
+    cache_prefix = 'user'
+
+    __slots__ = (
+        'email',
+        'social_id',
+        'user_id',
+        'api_keys',
+        '_created_at',
+        'admin_locked',
+        'admin_lock_user',
+        'admin_lock_reason',
+        '_admin_lock_at',
+        'indexed_terms',
+    )
+
+    created_at = _lazy_datetime('_created_at')
+    admin_lock_at = _lazy_datetime('_admin_lock_at')
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    __hash__ = object.__hash__
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return NotImplemented
+        return not equal
+
     def __init__(self, email, social_id, created_at, api_keys=None, **kwargs):
         self.email = email
         self.social_id = social_id
@@ -46,52 +338,60 @@ class User(UserMixin):
         self.admin_lock_user = kwargs.get('admin_lock_user')
         self.admin_lock_reason = kwargs.get('admin_lock_reason')
         self.admin_lock_at = kwargs.get('admin_lock_at')
+        # The terms this user is stored under in the secondary indexes
+        self.indexed_terms = None
 
     def get_id(self):
         return self.user_id
 
     @classmethod
     def get_by_user_id(clz, user_id):
-        cache = current_app.extensions['lfu_cache']
-        cached = cache.get('user.%s' % user_id)
-        if cached:
+        cache = current_app.extensions['key_cache']
+        found, cached = cache.get('user.%s' % user_id)
+        if found:
+            if cached is None:
+                current_app.logger.debug("Found missing user %s in negative cache", user_id)
+                return None
             current_app.logger.debug("Found user %s in cache: %s", user_id, cached.as_dict())
             return cached
 
-        s3 = boto3.client('s3')
+        return load_object(clz, user_id)
 
-        try:
-            res = s3.get_object(
-                Bucket=current_app.config.get('STORAGE_S3_BUCKET'),
-                Key=posixpath.join(current_app.config.get('STORAGE_S3_PREFIX'), 'users', user_id),
-            )
-            data = json.loads(res['Body'].read().decode('utf8'))
-            obj = clz.from_dict(data)
-            cache['user.%s' % user_id] = obj
-            current_app.logger.debug("Stored user %s in cache", user_id)
-            return obj
-
-        except s3.exceptions.NoSuchKey:
-            cache[user_id] = None
-            return None
+    # Look up several users at once, returning a dict of user ID to User (or
+    # None if it doesn't exist)
+    @classmethod
+    def get_many(clz, user_ids):
+        return get_many_objects(clz, user_ids)
 
     @classmethod
     def get_by_social_id(clz, social_id):
         user_id = hash_base64(social_id)
         return clz.get_by_user_id(user_id)
 
+    @classmethod
+    def scan(clz):
+        return scan_objects(clz)
+
     @classmethod
     def from_dict(clz, data):
-        return clz(
+        obj = clz(
             email=data['email'],
             social_id=data['social_id'],
-            created_at=datetime.datetime.utcfromtimestamp(data['created_at'] / 1000),
-            api_keys=data.get('api_keys', {}),
+            created_at=data['created_at'],
+            api_keys=dict((api_key, ApiKey.summarize(k)) for api_key, k in data.get('api_keys', {}).items()),
             admin_locked=data.get('admin_locked'),
             admin_lock_user=data.get('admin_lock_user'),
             admin_lock_reason=data.get('admin_lock_reason'),
-            admin_lock_at=datetime.datetime.utcfromtimestamp(data.get('admin_lock_at') / 1000) if data.get('admin_lock_at') else None,
+            admin_lock_at=data.get('admin_lock_at') or None,
         )
+        obj.indexed_terms = obj.index_terms()
+        return obj
+
+    def index_terms(self):
+        return {
+            'user_email': set([self.email.lower()]) if self.email else set(),
+            'user_state': set(['admin_locked']) if self.admin_locked else set(),
+        }
 
     @property
     def github_id(self):
@@ -104,33 +404,55 @@ class User(UserMixin):
         return {
             "email": self.email,
             "social_id": self.social_id,
-            "created_at": int(self.created_at.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000),
+            "created_at": _millis(self._created_at),
             "api_keys": self.api_keys,
             "admin_locked": self.admin_locked,
             "admin_lock_user": self.admin_lock_user,
             "admin_lock_reason": self.admin_lock_reason,
-            "admin_lock_at": int(self.admin_lock_at.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000) if self.admin_lock_at else None,
+            "admin_lock_at": _millis(self._admin_lock_at),
         }
 
+    def storage_location(self):
+        return self.collection, self.user_id, '%s.%s' % (self.cache_prefix, self.user_id)
+
     def save(self):
-        s3 = boto3.client('s3')
-        data = json.dumps(self.as_dict())
-        s3.put_object(
-            Bucket=current_app.config.get('STORAGE_S3_BUCKET'),
-            Key=posixpath.join(current_app.config.get('STORAGE_S3_PREFIX'), 'users', self.user_id),
-            Body=data,
-            ContentType='application/json',
-        )
-        cache = current_app.extensions['lfu_cache']
-        cache.pop('user.%s' % self.user_id, None)
+        with unit_of_work() as uow:
+            uow.save(self)
 
     def generate_random_key(self):
         k = ApiKey.generate_random_key_for(self)
-        self.api_keys[k.api_key] = k.as_dict()
+        self.api_keys[k.api_key] = k.summary()
         return k
 
+    # Fetch the full details of all this user's keys, oldest first
+    def get_api_keys(self):
+        keys = ApiKey.get_many(self.api_keys)
+        return sorted((k for k in keys.values() if k), key=lambda k: k.created_at)
+
 
 class ApiKey(object):
+    collection = 'keys'
+    cache_prefix = 'key'
+
+    __slots__ = (
+        '_created_at',
+        'person_id',
+        'api_key',
+        'name',
+        '_allowed_origins',
+        '_origin_matcher',
+        'enabled',
+        'rate_limit',
+        'admin_locked',
+        'admin_lock_user',
+        'admin_lock_reason',
+        '_admin_lock_at',
+        'indexed_terms',
+    )
+
+    created_at = _lazy_datetime('_created_at')
+    admin_lock_at = _lazy_datetime('_admin_lock_at')
+
     def __init__(self, person_id, api_key, enabled, name=None, allowed_origins=None, created_at=None, **kwargs):
         self.created_at = created_at
         self.person_id = person_id
@@ -138,10 +460,14 @@ class ApiKey(object):
         self.name = name
         self.allowed_origins = allowed_origins
         self.enabled = enabled
+        # Most verified requests allowed per rate limit window, or None for no limit
+        self.rate_limit = kwargs.get('rate_limit')
         self.admin_locked = kwargs.get('admin_locked') == True
         self.admin_lock_user = kwargs.get('admin_lock_user')
         self.admin_lock_reason = kwargs.get('admin_lock_reason')
         self.admin_lock_at = kwargs.get('admin_lock_at')
+        # The terms this key is stored under in the secondary indexes
+        self.indexed_terms = None
 
     @classmethod
     def generate_random_key_for(clz, user):
@@ -154,43 +480,66 @@ class ApiKey(object):
 
     @classmethod
     def get_by_api_key(clz, api_key):
-        cache = current_app.extensions['lfu_cache']
-        cached = cache.get('key.%s' % api_key)
-        if cached:
+        cache = current_app.extensions['key_cache']
+        found, cached = cache.get('key.%s' % api_key)
+        if found:
+            if cached is None:
+                current_app.logger.debug("Found missing key %s in negative cache", api_key)
+                return None
             current_app.logger.debug("Found key %s in cache: %s", api_key, cached.as_dict())
             return cached
 
-        s3 = boto3.client('s3')
+        return load_object(clz, api_key)
 
-        try:
-            res = s3.get_object(
-                Bucket=current_app.config.get('STORAGE_S3_BUCKET'),
-                Key=posixpath.join(current_app.config.get('STORAGE_S3_PREFIX'), 'keys', api_key),
-            )
-            data = json.loads(res['Body'].read().decode('utf8'))
-            obj = clz.from_dict(data)
-            cache['key.%s' % api_key] = obj
-            current_app.logger.debug("Stored key %s in cache", api_key)
-            return obj
-
-        except s3.exceptions.NoSuchKey:
-            cache['key.%s' % api_key] = None
-            return None
+    # Look up several API keys at once, returning a dict of API key to ApiKey
+    # (or None if it doesn't exist)
+    @classmethod
+    def get_many(clz, api_keys):
+        return get_many_objects(clz, api_keys)
+
+    @classmethod
+    def scan(clz):
+        return scan_objects(clz)
 
     @classmethod
     def from_dict(clz, data):
-        return clz(
+        obj = clz(
             person_id=data['person_id'],
             api_key=data['api_key'],
             enabled=data['enabled'],
             name=data['name'],
             allowed_origins=data.get('allowed_origins'),
-            created_at=datetime.datetime.utcfromtimestamp(data['created_at'] / 1000),
+            created_at=data['created_at'],
+            rate_limit=data.get('rate_limit'),
             admin_locked=data.get('admin_locked'),
             admin_lock_user=data.get('admin_lock_user'),
             admin_lock_reason=data.get('admin_lock_reason'),
-            admin_lock_at=datetime.datetime.utcfromtimestamp(data.get('admin_lock_at') / 1000) if data.get('admin_lock_at') else None,
+            admin_lock_at=data.get('admin_lock_at') or None,
         )
+        obj.indexed_terms = obj.index_terms()
+        return obj
+
+    def index_terms(self):
+        state = set()
+        if self.admin_locked:
+            state.add('admin_locked')
+        if not self.enabled:
+            state.add('disabled')
+
+        return {
+            'key_name': set([self.name.strip().lower()]) if self.name and self.name.strip() else set(),
+            'key_state': state,
+        }
+
+    # The few fields of a key stored alongside its ID in the owner's document
+    SUMMARY_FIELDS = ('name', 'enabled', 'admin_locked')
+
+    @classmethod
+    def summarize(clz, data):
+        return dict((field, data.get(field)) for field in clz.SUMMARY_FIELDS)
+
+    def summary(self):
+        return dict((field, getattr(self, field)) for field in self.SUMMARY_FIELDS)
 
     def as_dict(self):
         return {
@@ -199,42 +548,39 @@ class ApiKey(object):
             "enabled": self.enabled,
             "name": self.name,
             "allowed_origins": self.allowed_origins,
-            "created_at": int(self.created_at.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000),
+            "rate_limit": self.rate_limit,
+            "created_at": _millis(self._created_at),
             "admin_locked": self.admin_locked,
             "admin_lock_user": self.admin_lock_user,
             "admin_lock_reason": self.admin_lock_reason,
-            "admin_lock_at": int(self.admin_lock_at.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000) if self.admin_lock_at else None,
+            "admin_lock_at": _millis(self._admin_lock_at),
         }
 
+    def storage_location(self):
+        return self.collection, self.api_key, '%s.%s' % (self.cache_prefix, self.api_key)
+
     def save(self):
-        s3 = boto3.client('s3')
-        data = json.dumps(self.as_dict())
-        s3.put_object(
-            Bucket=current_app.config.get('STORAGE_S3_BUCKET'),
-            Key=posixpath.join(current_app.config.get('STORAGE_S3_PREFIX'), 'keys', self.api_key),
-            Body=data,
-            ContentType='application/json',
-        )
-        cache = current_app.extensions['lfu_cache']
-        cache.pop('key.%s' % self.api_key, None)
+        with unit_of_work() as uow:
+            uow.save(self)
 
     def delete(self):
-        s3 = boto3.client('s3')
-        s3.delete_object(
-            Bucket=current_app.config.get('STORAGE_S3_BUCKET'),
-            Key=posixpath.join(current_app.config.get('STORAGE_S3_PREFIX'), 'keys', self.api_key),
-        )
-        cache = current_app.extensions['lfu_cache']
-        cache.pop('key.%s' % self.api_key, None)
+        with unit_of_work() as uow:
+            uow.delete(self)
+
+    @property
+    def allowed_origins(self):
+        return self._allowed_origins
+
+    @allowed_origins.setter
+    def allowed_origins(self, allowed_origins):
+        self._allowed_origins = allowed_origins
+        self._origin_matcher = OriginMatcher(allowed_origins) if allowed_origins else None
 
     def is_origin_allowed(self, origin):
-        if not self.allowed_origins:
+        if not self._origin_matcher:
             return True
         else:
             if not origin:
                 return False
 
-            for allowed_origin in self.allowed_origins:
-                if fnmatch.fnmatch(origin, allowed_origin):
-                    return True
-            return False
+            return self._origin_matcher.matches(origin)
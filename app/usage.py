@@ -0,0 +1,146 @@
+import collections
+import datetime
+import json
+import threading
+import time
+import uuid
+from .background import run_periodically
+from .verify import VALID
+
+# Usage is counted per API key and origin in memory on the /verify hot path,
+# then flushed every few seconds as an immutable batch object in the
+# `usage/<date>` collection. Compaction merges those batches into one
+# `usage-keys` document per API key, holding daily counts per origin, and
+# deletes the batches it merged.
+#
+# Before merging, compaction records the batches it is about to merge under
+# an ID in `usage-compactions/<date>`, and each key's document records the
+# last compaction ID merged into it for each day. A compaction that stopped
+# part way is finished by the next one without counting any batch twice.
+#
+# Keys are public, so anyone can send requests with made up origins. Only
+# verified requests are counted under their origin, rejected ones are counted
+# together, and past `max_origins` distinct origins per key the rest are
+# folded into one bucket, both when counting and when compacting.
+OTHER = '(other)'
+REJECTED = '(rejected)'
+
+
+def cap_origins(origins, max_origins):
+    if len(origins) <= max_origins:
+        return origins
+
+    kept = collections.Counter(dict(collections.Counter(origins).most_common(max_origins)))
+    kept[OTHER] += sum(origins.values()) - sum(kept.values())
+    return kept
+
+
+class UsageMeter(object):
+    def __init__(self, app, interval, max_origins):
+        self.app = app
+        self.interval = interval
+        self.max_origins = max_origins
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._thread = None
+
+    def record(self, api_key, origin, verdict):
+        origin = (origin or '') if verdict == VALID else REJECTED
+        with self._lock:
+            origins = self._counts.get(api_key)
+            if origins is None:
+                origins = self._counts[api_key] = collections.Counter()
+            if origin not in origins and len(origins) >= self.max_origins:
+                origin = OTHER
+            origins[origin] += 1
+
+    def flush(self):
+        with self._lock:
+            batch, self._counts = self._counts, {}
+
+        if not batch:
+            return
+
+        now = time.time()
+        date = datetime.datetime.utcfromtimestamp(now).strftime('%Y-%m-%d')
+        name = '%013d.%s' % (int(now * 1000), uuid.uuid4().hex[:8])
+        self.app.extensions['storage'].put_object('usage/%s' % date, name, json.dumps(batch))
+
+    def start(self):
+        self._thread = run_periodically(
+            self.app, 'usage-meter', self.interval, self.flush, "Couldn't flush usage counts", at_exit=True)
+
+
+def _read(backend, collection, name):
+    body = backend.get_object(collection, name)
+    return json.loads(body.decode('utf8')) if body else None
+
+
+def _merge(backend, run, date, compaction, retain_days, max_origins):
+    collection = 'usage/%s' % date
+    names = compaction['batches']
+
+    totals = {}
+    for batch in run([(_read, (backend, collection, name)) for name in names]):
+        for api_key, origins in (batch or {}).items():
+            key_totals = totals.setdefault(api_key, collections.Counter())
+            key_totals.update(origins)
+
+    oldest = (datetime.datetime.strptime(date, '%Y-%m-%d') - datetime.timedelta(days=retain_days)).strftime('%Y-%m-%d')
+
+    def merge(api_key, origins):
+        doc = _read(backend, 'usage-keys', api_key) or {}
+        merged = doc.pop('compactions', {})
+        if merged.get(date) == compaction['id']:
+            return
+
+        day = collections.Counter(doc.get(date, {}))
+        day.update(origins)
+        doc[date] = dict(cap_origins(day, max_origins))
+        merged[date] = compaction['id']
+
+        doc = dict((d, v) for d, v in doc.items() if d > oldest)
+        doc['compactions'] = dict((d, v) for d, v in merged.items() if d > oldest)
+        backend.put_object('usage-keys', api_key, json.dumps(doc, sort_keys=True))
+
+    run([(merge, (api_key, origins)) for api_key, origins in totals.items()])
+    run([(backend.delete_object, (collection, name)) for name in names])
+    backend.delete_object('usage-compactions', date)
+
+
+# Merge the flushed batches for `date` into each API key's usage document and
+# delete them, keeping `retain_days` days of history per key, after finishing
+# any earlier compaction of that day that stopped part way. `run` calls a
+# list of (function, args) pairs, possibly concurrently, and returns their
+# results. Only one compaction should run at a time. Returns how many batches
+# were merged.
+def compact(backend, run, date, retain_days, max_origins):
+    merged = 0
+
+    unfinished = _read(backend, 'usage-compactions', date)
+    if unfinished:
+        _merge(backend, run, date, unfinished, retain_days, max_origins)
+        merged += len(unfinished['batches'])
+
+    names = list(backend.list_objects('usage/%s' % date))
+    if names:
+        compaction = {'id': uuid.uuid4().hex, 'batches': names}
+        backend.put_object('usage-compactions', date, json.dumps(compaction))
+        _merge(backend, run, date, compaction, retain_days, max_origins)
+        merged += len(names)
+
+    return merged
+
+
+# Returns a list of (date, total, {origin: count}) for the last `days` days
+# of compacted usage of an API key, newest first
+def usage_for_key(backend, api_key, days, today=None):
+    doc = _read(backend, 'usage-keys', api_key) or {}
+    today = today or datetime.datetime.utcnow().date()
+
+    history = []
+    for n in range(days):
+        date = (today - datetime.timedelta(days=n)).strftime('%Y-%m-%d')
+        origins = doc.get(date, {})
+        history.append((date, sum(origins.values()), origins))
+    return history
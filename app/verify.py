@@ -0,0 +1,69 @@
+import hashlib
+import json
+
+VALID = 'valid'
+UNKNOWN = 'unknown'
+DISABLED = 'disabled'
+ORIGIN_NOT_ALLOWED = 'origin_not_allowed'
+RATE_LIMITED = 'rate_limited'
+
+MESSAGES = {
+    VALID: 'Valid API key.',
+    UNKNOWN: 'Unknown API key.',
+    DISABLED: 'Disabled API key.',
+    ORIGIN_NOT_ALLOWED: 'Origin is not allowed by API key.',
+    RATE_LIMITED: 'API key is over its rate limit.',
+}
+
+# The HTTP status sent with each verdict
+STATUS_CODES = {
+    VALID: 200,
+    UNKNOWN: 400,
+    DISABLED: 400,
+    ORIGIN_NOT_ALLOWED: 400,
+    RATE_LIMITED: 429,
+}
+
+# The config setting holding the Cache-Control header sent with each verdict
+CACHE_CONTROL_SETTINGS = {
+    VALID: 'VERIFY_CACHE_CONTROL_SUCCESS',
+    UNKNOWN: 'VERIFY_CACHE_CONTROL_UNKNOWN',
+    DISABLED: 'VERIFY_CACHE_CONTROL_DISABLED',
+    ORIGIN_NOT_ALLOWED: 'VERIFY_CACHE_CONTROL_DISABLED',
+    RATE_LIMITED: 'VERIFY_CACHE_CONTROL_RATE_LIMITED',
+}
+
+
+# Decide whether a request using API key `k` (None if the key doesn't exist)
+# from `origin` should be allowed through. If a rate limiter is given, allowed
+# requests are counted against the key's rate limit.
+def verdict_for(k, origin, rate_limiter=None):
+    if not k:
+        return UNKNOWN
+
+    if not k.enabled:
+        return DISABLED
+
+    if not k.is_origin_allowed(origin):
+        return ORIGIN_NOT_ALLOWED
+
+    if rate_limiter and k.rate_limit and not rate_limiter.allow(k.api_key, k.rate_limit):
+        return RATE_LIMITED
+
+    return VALID
+
+
+def verdict_as_dict(verdict):
+    return {
+        'result': 'success' if verdict == VALID else 'error',
+        'message': MESSAGES[verdict],
+    }
+
+
+# A strong validator for the verdict on `api_key`/`origin`, which changes
+# whenever the parts of the key's state that affect the verdict change
+def verdict_etag(verdict, api_key, origin, k):
+    state = [verdict, api_key, origin]
+    if k:
+        state.extend([k.enabled, k.allowed_origins])
+    return hashlib.sha1(json.dumps(state).encode('utf8')).hexdigest()
@@ -0,0 +1,4 @@
+import os
+from app.asgi import create_service
+
+app = create_service(os.environ.get('DEVELOPERS_ENV', 'default'))
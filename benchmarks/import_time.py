@@ -0,0 +1,77 @@
+"""
+Profiles what a cold start spends importing and building the app, with
+LAZY_STARTUP off and on, using `python -X importtime`.
+
+    python benchmarks/import_time.py --top 15
+
+Each mode runs in a fresh interpreter that imports the app and calls
+create_app, configured for S3 storage and Sentry so their imports show up.
+Nothing is sent over the network.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app(%r)
+created = time.perf_counter()
+print('%%f %%f' %% (imported - start, created - imported))
+"""
+
+
+def profile(config_name, lazy):
+    env = dict(os.environ)
+    env.setdefault('STORAGE_BACKEND', 's3')
+    env.setdefault('STORAGE_S3_BUCKET', 'import-profile')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('SENTRY_ENABLE', 'true')
+    env['LAZY_STARTUP'] = 'true' if lazy else 'false'
+
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE % config_name],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode:
+        sys.exit(proc.stderr)
+
+    # Lines look like "import time: self [us] | cumulative | module". Each
+    # module's own time is charged to its top-level package.
+    packages = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        top = name.strip().split('.')[0]
+        packages[top] = packages.get(top, 0) + int(own)
+
+    import_seconds, create_seconds = map(float, proc.stdout.split()[-2:])
+    return import_seconds, create_seconds, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='production', help='config to create the app with')
+    parser.add_argument('--top', type=int, default=10, help='number of packages to list')
+    args = parser.parse_args()
+
+    for lazy in (False, True):
+        import_seconds, create_seconds, packages = profile(args.config, lazy)
+        print('LAZY_STARTUP=%s: import app %.1fms, create_app %.1fms, %d top-level packages imported' % (
+            'true' if lazy else 'false', import_seconds * 1000, create_seconds * 1000, len(packages)))
+        for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+            print('  %8.1fms  %s' % (us / 1000.0, name))
+        print('')
+
+
+if __name__ == '__main__':
+    main()
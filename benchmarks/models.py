@@ -0,0 +1,108 @@
+"""
+Measures how long it takes to decode stored users and keys into model
+objects, and how much cache memory each one takes, with each storage codec.
+
+    python benchmarks/models.py --count 20000
+
+The msgpack codec is skipped if the msgpack package isn't installed.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import codec  # noqa: E402
+from app.cache import deep_getsizeof  # noqa: E402
+from app.storage import ApiKey, User  # noqa: E402
+
+
+def sample_keys(count):
+    now = datetime.datetime.utcnow()
+    keys = []
+    for n in range(count):
+        k = ApiKey(
+            person_id='person%06d' % (n // 3),
+            api_key='key%019d' % n,
+            enabled=n % 10 != 0,
+            name='Key %d' % n if n % 2 else None,
+            allowed_origins=['https://app%d.example.com' % n, 'https://*.example%d.org' % n] if n % 3 else None,
+            created_at=now - datetime.timedelta(seconds=random.randint(0, 10 ** 8)),
+            rate_limit=1000 if n % 5 == 0 else None,
+        )
+        if n % 50 == 0:
+            k.admin_locked = True
+            k.admin_lock_at = now
+            k.admin_lock_reason = 'Abuse'
+        keys.append(k)
+    return keys
+
+
+def sample_users(keys):
+    users = {}
+    for k in keys:
+        u = users.get(k.person_id)
+        if u is None:
+            u = users[k.person_id] = User(
+                email='%s@example.com' % k.person_id,
+                social_id='github$%s' % k.person_id[6:],
+                created_at=k.created_at,
+            )
+        u.api_keys[k.api_key] = k.summary()
+    return list(users.values())
+
+
+def measure(clz, objects, name, touch_timestamps, repeat):
+    bodies = [codec.encode(obj.as_dict(), name)[0] for obj in objects]
+    bodies = [b.encode('utf8') if isinstance(b, str) else b for b in bodies]
+
+    # Keep the fastest of several runs to reduce noise
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        decoded = [clz.from_dict(codec.decode(body)) for body in bodies]
+        if touch_timestamps:
+            for obj in decoded:
+                obj.created_at
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return (
+        best / len(objects) * 1e6,
+        sum(len(b) for b in bodies) / float(len(bodies)),
+        sum(deep_getsizeof(obj) for obj in decoded) / float(len(decoded)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=10000, help='number of keys, a third as many users')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each measurement, keeping the fastest')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    keys = sample_keys(args.count)
+    users = sample_users(keys)
+
+    codecs = [codec.JSON]
+    try:
+        import msgpack  # noqa: F401
+        codecs.append(codec.MSGPACK)
+    except ImportError:
+        print('msgpack is not installed, skipping it')
+
+    print('%-6s %-8s %-20s %12s %12s %14s' % ('model', 'codec', 'timestamps', 'decode us', 'stored B', 'cache B/entry'))
+    for clz, objects in [(ApiKey, keys), (User, users)]:
+        for name in codecs:
+            for touch in (False, True):
+                us, stored, cached = measure(clz, objects, name, touch, args.repeat)
+                print('%-6s %-8s %-20s %12.2f %12.0f %14.0f' % (
+                    clz.__name__, name, 'decoded' if touch else 'left as stored', us, stored, cached))
+
+
+if __name__ == '__main__':
+    main()
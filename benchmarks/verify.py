@@ -0,0 +1,267 @@
+"""
+Benchmarks /verify against an in-process stand-in for S3 that adds a fixed
+latency to every call, so regressions in the cache and lookup paths show up
+without network noise.
+
+    python benchmarks/verify.py --users 500 --keys-per-user 4 --threads 16
+
+Each phase reports throughput and latency percentiles:
+
+    hit       hot keys already in the key cache
+    miss      known keys evicted from the cache before each request
+    negative  unknown keys, mostly answered from the negative cache
+    mixed     Zipf-distributed hot keys with some unknown keys and a mix of
+              exact, wildcard and disallowed origins
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import os
+import random
+import sys
+import threading
+import time
+from types import SimpleNamespace
+import botocore.session
+from botocore.exceptions import ClientError, ParamValidationError
+from botocore.validate import ParamValidator
+
+os.environ.setdefault('STORAGE_BACKEND', 's3')
+os.environ.setdefault('STORAGE_S3_BUCKET', 'benchmark')
+os.environ.setdefault('CHANGE_FEED_ENABLE', 'false')
+os.environ.setdefault('HOT_KEYS_ENABLE', 'false')
+os.environ.setdefault('RATE_LIMIT_ENABLE', 'false')
+os.environ.setdefault('USAGE_METERING_ENABLE', 'false')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from app.storage import User, unit_of_work  # noqa: E402
+
+
+# Just enough of a boto3 S3 client for S3Backend, kept in memory. Calls are
+# validated against the installed botocore's S3 model, so parameters the real
+# client would reject are rejected here too.
+class FakeS3Client(object):
+    class exceptions(object):
+        ClientError = ClientError
+
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.objects = {}
+        self.calls = 0
+        self.meta = SimpleNamespace(service_model=botocore.session.get_session().get_service_model('s3'))
+        self._validator = ParamValidator()
+        self._lock = threading.Lock()
+
+    def _call(self, operation, params):
+        shape = self.meta.service_model.operation_model(operation).input_shape
+        errors = self._validator.validate(params, shape)
+        if errors.has_errors():
+            raise ParamValidationError(report=errors.generate_report())
+
+        with self._lock:
+            self.calls += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+
+    def _etag(self, body):
+        return '"%s"' % hashlib.md5(body).hexdigest()
+
+    def get_object(self, **params):
+        self._call('GetObject', params)
+        try:
+            body = self.objects[(params['Bucket'], params['Key'])]
+        except KeyError:
+            raise self.exceptions.NoSuchKey(params['Key'])
+        return {'Body': io.BytesIO(body), 'ETag': self._etag(body)}
+
+    def put_object(self, **params):
+        self._call('PutObject', params)
+        body = params['Body']
+        if isinstance(body, str):
+            body = body.encode('utf8')
+
+        key = (params['Bucket'], params['Key'])
+        with self._lock:
+            current = self.objects.get(key)
+            if params.get('IfNoneMatch') == '*' and current is not None:
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+            if params.get('IfMatch') and (current is None or self._etag(current) != params['IfMatch']):
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+            self.objects[key] = body
+
+    def delete_object(self, **params):
+        self._call('DeleteObject', params)
+        self.objects.pop((params['Bucket'], params['Key']), None)
+
+    def delete_objects(self, **params):
+        self._call('DeleteObjects', params)
+        for obj in params['Delete']['Objects']:
+            self.objects.pop((params['Bucket'], obj['Key']), None)
+        return {}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, **params):
+        self._call('ListObjectsV2', params)
+        prefix, start_after = params.get('Prefix', ''), params.get('StartAfter', '')
+        keys = sorted(k for b, k in list(self.objects) if b == params['Bucket'] and k.startswith(prefix) and k > start_after)
+        for start in range(0, len(keys), 1000):
+            yield {'Contents': [{'Key': k} for k in keys[start:start + 1000]]}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def seed(app, users, keys_per_user):
+    keys = []
+    with app.app_context():
+        for n in range(users):
+            with unit_of_work():
+                u = User(email='user%d@example.com' % n, social_id='github$%d' % n, created_at=datetime.datetime.utcnow())
+                for _ in range(keys_per_user):
+                    k = u.generate_random_key()
+                    k.allowed_origins = ['https://app%d.example.com' % n, 'https://*.example%d.org' % n]
+                    k.save()
+                    keys.append((k.api_key, n))
+                u.save()
+    return keys
+
+
+# Sends every query in `work` from `threads` threads, each with its own test
+# client. `prepare` runs untimed before each request.
+def run_phase(app, work, threads, prepare=None):
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    it = iter(work)
+
+    def worker():
+        client = app.test_client()
+        mine = []
+        codes = {}
+        while True:
+            with lock:
+                query = next(it, None)
+            if query is None:
+                break
+            if prepare:
+                prepare(query)
+            start = time.perf_counter()
+            resp = client.get('/verify', query_string=query)
+            mine.append(time.perf_counter() - start)
+            codes[resp.status_code] = codes.get(resp.status_code, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for code, n in codes.items():
+                statuses[code] = statuses.get(code, 0) + n
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - start, latencies, statuses
+
+
+def report(name, elapsed, latencies, statuses, storage_calls):
+    print('%-9s %7d req %9.0f req/s   p50 %7.2fms   p95 %7.2fms   p99 %7.2fms   storage calls %6d   %s' % (
+        name,
+        len(latencies),
+        len(latencies) / elapsed if elapsed else 0,
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000,
+        storage_calls,
+        ' '.join('%d:%d' % item for item in sorted(statuses.items())),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--keys-per-user', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=5000, help='requests per phase')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='added to every storage call')
+    parser.add_argument('--jitter-ms', type=float, default=2.0)
+    parser.add_argument('--hot-keys', type=int, default=50)
+    parser.add_argument('--unknown-keys', type=int, default=500)
+    parser.add_argument('--unknown-ratio', type=float, default=0.05, help='share of unknown keys in the mixed phase')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--config', default='production', help='config to create the app with')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    app = create_app(args.config)
+    client = FakeS3Client()
+    app.extensions['storage'].backend.client = client
+    cache = app.extensions['key_cache']
+
+    keys = seed(app, args.users, args.keys_per_user)
+    client.latency = args.latency_ms / 1000.0
+    client.jitter = args.jitter_ms / 1000.0
+    print('Seeded %d users with %d keys, storage latency %.1fms + up to %.1fms' % (
+        args.users, len(keys), args.latency_ms, args.jitter_ms))
+
+    def origin_for(n):
+        return random.choice([
+            'https://app%d.example.com' % n,
+            'https://api.example%d.org' % n,
+            'https://evil.example.net',
+            None,
+        ])
+
+    def query(api_key, origin):
+        return dict(api_key=api_key, **({'origin': origin} if origin else {}))
+
+    hot = random.sample(keys, min(args.hot_keys, len(keys)))
+    unknown = ['unknown%06d' % n for n in range(args.unknown_keys)]
+    weights = [1.0 / (rank + 1) for rank in range(len(hot))]
+
+    phases = []
+
+    # Warm the hot keys first so the hit phase only measures cache hits
+    warm = app.test_client()
+    for api_key, n in hot:
+        warm.get('/verify', query_string=query(api_key, None))
+    phases.append(('hit', [query(k, origin_for(n)) for k, n in random.choices(hot, weights, k=args.requests)], None))
+
+    phases.append((
+        'miss',
+        [query(k, origin_for(n)) for k, n in random.choices(keys, k=args.requests)],
+        lambda q: cache.pop('key.' + q['api_key']),
+    ))
+
+    phases.append(('negative', [query(random.choice(unknown), None) for _ in range(args.requests)], None))
+
+    mixed = []
+    for _ in range(args.requests):
+        if random.random() < args.unknown_ratio:
+            mixed.append(query(random.choice(unknown), None))
+        else:
+            k, n = random.choices(hot, weights)[0]
+            mixed.append(query(k, origin_for(n)))
+    phases.append(('mixed', mixed, None))
+
+    for name, work, prepare in phases:
+        calls = client.calls
+        elapsed, latencies, statuses = run_phase(app, work, args.threads, prepare)
+        report(name, elapsed, latencies, statuses, client.calls - calls)
+
+
+if __name__ == '__main__':
+    main()
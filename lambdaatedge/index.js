@@ -6,6 +6,13 @@ const LRU = require("lru-cache"),
       lru = LRU(100);
 const ONE_HOUR = 1 * 60 * 60 * 1000;
 
+// Cache verdicts for as long as the verify endpoint's Cache-Control allows,
+// falling back to an hour if it doesn't say.
+function maxAgeMillis(headers) {
+    const match = /max-age=(\d+)/.exec((headers && headers['cache-control']) || '');
+    return match ? parseInt(match[1], 10) * 1000 : ONE_HOUR;
+}
+
 exports.handler = (event, context, callback) => {
     const request = event.Records[0].cf.request;
     console.log(lru.length + " keys in the lru");
@@ -66,7 +73,7 @@ exports.handler = (event, context, callback) => {
         .then(function (response) {
             console.log(`Received verify response ` + JSON.stringify(response.data));
 
-            lru.set(verify_querystring, response.data, ONE_HOUR);
+            lru.set(verify_querystring, response.data, maxAgeMillis(response.headers));
 
             console.log(`Set key ${verify_querystring} to ` + JSON.stringify(response.data));
 
@@ -76,9 +83,9 @@ exports.handler = (event, context, callback) => {
             if (error.code === 'ECONNABORTED') {
                 console.log('Timed out waiting for API key check');
                 return callback(null, request);
-            } else if (error.response.status == 400) {
+            } else if (error.response.status == 400 || error.response.status == 429) {
                 console.log(`Received verify response ` + JSON.stringify(error.response.data));
-                lru.set(verify_querystring, error.response.data, ONE_HOUR);
+                lru.set(verify_querystring, error.response.data, maxAgeMillis(error.response.headers));
                 return callback(null, {
                     status: '400',
                     statusDescription: 'Invalid API Key',